@@ -0,0 +1,53 @@
+import argparse
+import time
+import numpy as np
+from PIL import Image
+
+from motion import transform_image, KenBurnsRenderer
+
+
+def make_test_image(width, height):
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)
+    pixels = np.empty((height, width, 3), dtype=np.uint8)
+    pixels[..., 0] = x[None, :]
+    pixels[..., 1] = y[:, None]
+    pixels[..., 2] = (x[None, :] + y[:, None]) / 2
+    return Image.fromarray(pixels)
+
+
+def measure(name, n_frames, render):
+    start = time.perf_counter()
+    for i in range(n_frames):
+        render(i)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<24}{n_frames / elapsed:>10.1f} 帧/秒")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='运镜渲染性能测试')
+    parser.add_argument('--width', type=int, default=1920, help='图片宽度')
+    parser.add_argument('--height', type=int, default=1080, help='图片高度')
+    parser.add_argument('--fps', type=int, default=60, help='视频帧数')
+    parser.add_argument('--frames', type=int, default=120, help='每种方式渲染的帧数')
+    args = parser.parse_args()
+
+    img = make_test_image(args.width, args.height)
+    duration = args.frames / args.fps
+    x_speed = (img.width - img.width * 0.8) / duration
+
+    print(f"图片尺寸 {args.width}x{args.height}，每种方式渲染 {args.frames} 帧")
+    measure('transform_image', args.frames,
+            lambda i: np.array(transform_image(img, i / args.fps, x_speed, 0, True, True)))
+
+    for smooth in (False, True):
+        start = time.perf_counter()
+        renderer = KenBurnsRenderer(img, args.frames, args.fps, x_speed, 0, True, True, smooth=smooth)
+        setup = time.perf_counter() - start
+        name = 'KenBurnsRenderer(smooth)' if smooth else 'KenBurnsRenderer'
+        measure(name, args.frames, renderer.render)
+        print(f"{'':<24}预计算耗时 {setup * 1000:.1f} 毫秒")
+
+
+if __name__ == '__main__':
+    main()
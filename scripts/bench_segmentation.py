@@ -0,0 +1,51 @@
+import argparse
+import os
+import time
+import spacy
+
+import step1_extract_keywords as step1
+
+
+def time_legacy(paragraphs):
+    start = time.perf_counter()
+    nlp = spacy.load('zh_core_web_sm')
+    loaded = time.perf_counter()
+    sentences = []
+    for paragraph in paragraphs:
+        sentences.extend([sent.text for sent in nlp(paragraph).sents])
+    return loaded - start, time.perf_counter() - loaded, len(sentences)
+
+
+def time_current(paragraphs, segmenter, n_process, batch_size):
+    step1.nlp = None
+    start = time.perf_counter()
+    step1.get_nlp(segmenter)
+    loaded = time.perf_counter()
+    sentences = step1.split_sentences(paragraphs, segmenter, n_process, batch_size)
+    return loaded - start, time.perf_counter() - loaded, len(sentences)
+
+
+def report(name, load_time, segment_time, count):
+    print(f"{name:<34}加载 {load_time:>7.2f} 秒  分句 {segment_time:>7.2f} 秒  合计 {load_time + segment_time:>7.2f} 秒  {count} 句")
+
+
+def main():
+    default_input = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'input.docx')
+    parser = argparse.ArgumentParser(description='分句性能测试')
+    parser.add_argument('--input_file', type=str, default=default_input, help='输入的docx文件路径')
+    parser.add_argument('--repeat', type=int, default=1, help='把文档内容重复多少遍，用来模拟长篇小说')
+    parser.add_argument('--processes', type=int, default=2, help='多进程分句时使用的进程数')
+    parser.add_argument('--batch_size', type=int, default=64, help='nlp.pipe 每批的段落数')
+    args = parser.parse_args()
+
+    paragraphs = step1.read_docx(args.input_file) * args.repeat
+    print(f"共 {len(paragraphs)} 段，{sum(len(p) for p in paragraphs)} 字")
+
+    report('完整模型，逐段调用 nlp()', *time_legacy(paragraphs))
+    report('仅 parser，nlp.pipe', *time_current(paragraphs, 'parser', 1, args.batch_size))
+    report(f'仅 parser，nlp.pipe × {args.processes} 进程', *time_current(paragraphs, 'parser', args.processes, args.batch_size))
+    report('规则分句 sentencizer，nlp.pipe', *time_current(paragraphs, 'sentencizer', 1, args.batch_size))
+
+
+if __name__ == '__main__':
+    main()
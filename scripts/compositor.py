@@ -0,0 +1,49 @@
+import numpy as np
+from PIL import Image, ImageFilter
+
+
+def make_background(img, enlarge_background):
+    img_blur = img.filter(ImageFilter.GaussianBlur(radius=30))
+    if enlarge_background:
+        img_blur = img_blur.resize((int(img.width * 1.1), int(img.height * 1.1)), Image.ANTIALIAS)
+    return img_blur
+
+
+# 毛玻璃背景是静止的，只在段开始时模糊、放大一次放进画布；之后每一帧由运镜渲染器
+# 直接写进画布中前景所在的区域，背景边框保持不动，不再逐帧做通用的多图层合成。
+# 前景位置与 CompositeVideoClip 的 "center" 定位一致：int((背景尺寸 - 前景尺寸) / 2)。
+class BackgroundCompositor:
+    def __init__(self, background, renderer):
+        if background.mode != 'RGB':
+            background = background.convert('RGB')
+
+        self._renderer = renderer
+        self._canvas = np.array(background)
+        self.size = background.size
+
+        canvas_height, canvas_width = self._canvas.shape[:2]
+        width, height = renderer.size
+        x = int((canvas_width - width) / 2)
+        y = int((canvas_height - height) / 2)
+
+        # 前景比背景大时，超出画布的部分会被裁掉
+        src_x, src_y = max(0, -x), max(0, -y)
+        dst_x, dst_y = max(0, x), max(0, y)
+        region_width = min(width - src_x, canvas_width - dst_x)
+        region_height = min(height - src_y, canvas_height - dst_y)
+
+        self._region = self._canvas[dst_y:dst_y + region_height, dst_x:dst_x + region_width]
+        self._clipped = (src_x, src_y, region_width, region_height) != (0, 0, width, height)
+        self._src = (src_y, src_y + region_height, src_x, src_x + region_width)
+
+    def render(self, frame_index):
+        if self._clipped:
+            frame = self._renderer.render(frame_index)
+            top, bottom, left, right = self._src
+            np.copyto(self._region, frame[top:bottom, left:right])
+        else:
+            self._renderer.render(frame_index, out=self._region)
+        return self._canvas
+
+    def make_frame(self, t):
+        return self.render(self._renderer.frame_index(t))
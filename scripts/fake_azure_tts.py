@@ -0,0 +1,88 @@
+import io
+import re
+import html
+import math
+import time
+import wave
+import random
+import datetime
+from azure.cognitiveservices.speech import ResultReason
+
+BOOKMARK = re.compile(r"<bookmark\s+mark=['\"]([^'\"]*)['\"]\s*/>")
+TAG = re.compile(r'<[^>]+>')
+
+
+class EventSignal:
+    def __init__(self):
+        self._handlers = []
+
+    def connect(self, handler):
+        self._handlers.append(handler)
+
+    def fire(self, event):
+        for handler in self._handlers:
+            handler(event)
+
+
+class BookmarkEvent:
+    def __init__(self, text, audio_offset):
+        self.text = text
+        self.audio_offset = audio_offset
+
+
+class FakeResult:
+    def __init__(self, audio_data, duration):
+        self.reason = ResultReason.SynthesizingAudioCompleted
+        self.audio_data = audio_data
+        self.audio_duration = datetime.timedelta(seconds=duration)
+
+
+class FakeFuture:
+    def __init__(self, run):
+        self._run = run
+
+    def get(self):
+        return self._run()
+
+
+# 本地模拟的 Azure 语音合成器，只实现配音脚本用到的 speak_ssml_async().get() 和 bookmark_reached，
+# 用来在没有密钥的机器上测试。每个字生成一段固定时长的音调，每句换一个音高，书签事件带上它在音频中的偏移；
+# 输出与 Azure 默认格式一样的 16kHz 16 位单声道 WAV。可以模拟请求耗时和随机出错。
+class FakeSynthesizer:
+    def __init__(self, delay=0.2, fail_rate=0.0, seconds_per_char=0.12, sample_rate=16000):
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.seconds_per_char = seconds_per_char
+        self.sample_rate = sample_rate
+        self.bookmark_reached = EventSignal()
+
+    def speak_ssml_async(self, ssml):
+        return FakeFuture(lambda: self._speak(ssml))
+
+    def _speak(self, ssml):
+        time.sleep(self.delay)
+        if random.random() < self.fail_rate:
+            raise RuntimeError("fake synthesis failure")
+
+        # 切分结果为 [书签前的文本, 书签1, 文本1, 书签2, 文本2, ...]
+        parts = BOOKMARK.split(ssml)
+        samples = bytearray()
+        self._append_tone(samples, parts[0], 0)
+        for number, (mark, text) in enumerate(zip(parts[1::2], parts[2::2]), 1):
+            self.bookmark_reached.fire(BookmarkEvent(mark, len(samples) // 2 * 10_000_000 // self.sample_rate))
+            self._append_tone(samples, text, number)
+
+        buffer = io.BytesIO()
+        with wave.open(buffer, 'wb') as writer:
+            writer.setnchannels(1)
+            writer.setsampwidth(2)
+            writer.setframerate(self.sample_rate)
+            writer.writeframes(bytes(samples))
+        return FakeResult(buffer.getvalue(), len(samples) // 2 / self.sample_rate)
+
+    def _append_tone(self, samples, text, number):
+        chars = len(''.join(html.unescape(TAG.sub('', text)).split()))
+        frequency = 220 + 40 * (number % 8)
+        for i in range(int(chars * self.seconds_per_char * self.sample_rate)):
+            value = int(6000 * math.sin(2 * math.pi * frequency * i / self.sample_rate))
+            samples += value.to_bytes(2, 'little', signed=True)
@@ -0,0 +1,69 @@
+import argparse
+import asyncio
+import base64
+import io
+import json
+import random
+import zlib
+from aiohttp import web
+from PIL import Image
+
+
+# 本地模拟的 Stable Diffusion WebUI，只实现 txt2img 和 progress 两个接口，用来在没有显卡的机器上
+# 测试绘图客户端。与真实 WebUI 一样一次只画一张，可以模拟绘图耗时和随机出错。
+class FakeWebUI:
+    def __init__(self, delay=1.0, fail_rate=0.0):
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.lock = asyncio.Lock()
+        self.jobs = 0
+
+    async def progress(self, request):
+        return web.json_response({'progress': 0.0, 'eta_relative': 0.0, 'state': {'job_count': self.jobs}, 'current_image': None})
+
+    async def txt2img(self, request):
+        payload = await request.json()
+        self.jobs += 1
+        try:
+            async with self.lock:
+                await asyncio.sleep(self.delay)
+                if random.random() < self.fail_rate:
+                    return web.json_response({'error': 'fake failure'}, status=500)
+
+                prompt = payload.get('prompt', '')
+                seed = payload.get('seed', -1)
+                if seed == -1:
+                    seed = random.randint(0, 2 ** 32 - 1)
+                width = int(payload.get('width', 512))
+                height = int(payload.get('height', 512))
+                color = zlib.crc32(f'{prompt}:{seed}'.encode('utf-8')).to_bytes(4, 'big')[:3]
+
+                buffer = io.BytesIO()
+                Image.new('RGB', (width, height), tuple(color)).save(buffer, 'PNG')
+                info = {'prompt': prompt, 'seed': seed, 'all_seeds': [seed], 'width': width, 'height': height}
+                return web.json_response({'images': [base64.b64encode(buffer.getvalue()).decode('ascii')], 'parameters': payload, 'info': json.dumps(info)})
+        finally:
+            self.jobs -= 1
+
+
+def make_app(delay=1.0, fail_rate=0.0):
+    fake = FakeWebUI(delay, fail_rate)
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_get('/sdapi/v1/progress', fake.progress)
+    app.router.add_post('/sdapi/v1/txt2img', fake.txt2img)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='模拟的 Stable Diffusion WebUI')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='监听地址')
+    parser.add_argument('--port', type=int, default=7860, help='监听端口')
+    parser.add_argument('--delay', type=float, default=1.0, help='每张图模拟的绘图耗时（秒）')
+    parser.add_argument('--fail_rate', type=float, default=0.0, help='随机返回 500 错误的概率')
+    args = parser.parse_args()
+
+    web.run_app(make_app(args.delay, args.fail_rate), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import os
+import re
+import subprocess
+import tempfile
+from moviepy.config import get_setting
+
+VIDEO_STREAM = re.compile(r'Stream #\d+:\d+.*?: Video: (?P<codec>\w+)(?: \((?P<profile>[^)]*)\))?.*?, (?P<pix_fmt>\w+)(?:\([^)]*\))?, (?P<size>\d+x\d+)')
+AUDIO_STREAM = re.compile(r'Stream #\d+:\d+.*?: Audio: (?P<codec>\w+)(?: \((?P<profile>[^)]*)\))?.*?, (?P<rate>\d+) Hz, (?P<layout>[^,]+), (?P<sample_fmt>\w+)')
+FPS = re.compile(r'(?P<fps>[\d.]+k?) fps')
+TBN = re.compile(r'(?P<tbn>[\d.]+k?) tbn')
+DURATION = re.compile(r'Duration: (?P<hours>\d+):(?P<minutes>\d+):(?P<seconds>[\d.]+)')
+
+
+def get_ffmpeg_binary():
+    return get_setting("FFMPEG_BINARY")
+
+
+def probe_streams(path):
+    # 只借用 ffmpeg -i 的输出，不依赖 ffprobe（moviepy 自带的 imageio-ffmpeg 只有 ffmpeg）
+    result = subprocess.run([get_ffmpeg_binary(), '-hide_banner', '-i', path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    info = result.stderr.decode('utf-8', errors='ignore')
+
+    streams = []
+    for line in info.splitlines():
+        video = VIDEO_STREAM.search(line)
+        if video:
+            fps = FPS.search(line)
+            tbn = TBN.search(line)
+            streams.append(('video', video['codec'], video['profile'], video['pix_fmt'], video['size'],
+                            fps['fps'] if fps else None, tbn['tbn'] if tbn else None))
+            continue
+        audio = AUDIO_STREAM.search(line)
+        if audio:
+            streams.append(('audio', audio['codec'], audio['profile'], audio['rate'], audio['layout'].strip(), audio['sample_fmt']))
+    return tuple(streams)
+
+
+def probe_duration(path):
+    result = subprocess.run([get_ffmpeg_binary(), '-hide_banner', '-i', path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    match = DURATION.search(result.stderr.decode('utf-8', errors='ignore'))
+    if not match:
+        return None
+    return int(match['hours']) * 3600 + int(match['minutes']) * 60 + float(match['seconds'])
+
+
+def can_stream_copy(paths):
+    signatures = {probe_streams(path) for path in paths}
+    return len(signatures) == 1 and all(signatures)
+
+
+def concat_stream_copy(paths, output_file, durations=None):
+    # concat demuxer 按容器层直接拼接，不解码也不重新编码；
+    # 给出 durations 时按指定时长排列各片段，不受片段末帧时长的影响
+    durations = durations or [None] * len(paths)
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False, encoding='utf-8') as f:
+        for path, duration in zip(paths, durations):
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+            if duration:
+                f.write(f"duration {duration:.6f}\n")
+        list_file = f.name
+
+    try:
+        result = subprocess.run([get_ffmpeg_binary(), '-hide_banner', '-loglevel', 'error', '-y',
+                                 '-f', 'concat', '-safe', '0', '-i', list_file,
+                                 '-c', 'copy', '-movflags', '+faststart', output_file],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    finally:
+        os.remove(list_file)
+
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode('utf-8', errors='ignore').strip())
+    return output_file
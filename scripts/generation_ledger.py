@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from manifest import ROOT_DIR, relative_path
+
+
+def params_hash(payload):
+    # 提示词和种子单独记录，其余参数（尺寸、采样器、插件等）合起来取哈希
+    shared = json.dumps({key: value for key, value in payload.items() if key not in ('prompt', 'seed')}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(shared.encode('utf-8')).hexdigest()[:12], shared
+
+
+def request_key(payload):
+    return payload.get('prompt', ''), params_hash(payload)[0], payload.get('seed', -1)
+
+
+def parse_info(result):
+    # WebUI 回复里的 info 是 JSON 字符串，实际使用的种子在 seed 字段
+    try:
+        info = json.loads(result.get('info') or '{}')
+    except (TypeError, ValueError, AttributeError):
+        return None, None
+    if not isinstance(info, dict):
+        return None, None
+    return info.get('seed'), result.get('info')
+
+
+def derive_seed(prompt, hash_value, attempt):
+    # 确定性地换种子：同一提示词和参数的第 n 次重绘总是得到同一个种子，画面可以复现
+    return int(hashlib.sha256(f'{prompt}:{hash_value}:{attempt}'.encode('utf-8')).hexdigest()[:8], 16)
+
+
+# 绘图台账：每张图的提示词、参数哈希、请求的种子、实际种子、info 和输出路径都记下来，
+# 提示词和参数都相同的请求直接复用已有的好图；被要求重绘的图标记为 rejected，不再被复用。
+# slot 是去掉扩展名的输出位置（例如 image/output_7），同一位置换了图片格式也能对上。多个线程共用一个实例。
+# 同一位置画了新图后，之前的记录标记为 superseded：文件已经被覆盖，不能再按旧提示词复用。
+class GenerationLedger:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            prompt TEXT NOT NULL,
+            params_hash TEXT NOT NULL,
+            requested_seed INTEGER,
+            seed INTEGER,
+            info TEXT,
+            output_path TEXT NOT NULL,
+            slot TEXT NOT NULL,
+            reused_from INTEGER,
+            status TEXT NOT NULL,
+            created REAL NOT NULL)''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS images_request ON images (prompt, params_hash)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS images_slot ON images (slot)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS params (hash TEXT PRIMARY KEY, params TEXT NOT NULL)')
+        # 旧版本的台账里同一位置可能有多条 ok 记录，只保留最新的一条
+        self._conn.execute('UPDATE images SET status = ? WHERE status = ? AND id NOT IN (SELECT MAX(id) FROM images WHERE status = ? GROUP BY slot)',
+                           ('superseded', 'ok', 'ok'))
+        self._conn.commit()
+        self.reused = 0
+        # 正在绘制的请求，键为 request_key，值为画完时完成的 future；只在事件循环线程里使用
+        self.pending = {}
+
+    @staticmethod
+    def slot(output_path):
+        return os.path.splitext(relative_path(output_path))[0]
+
+    def record(self, payload, output_path, seed, info, reused_from=None):
+        hash_value, shared = params_hash(payload)
+        with self._lock:
+            self._conn.execute('INSERT OR IGNORE INTO params (hash, params) VALUES (?, ?)', (hash_value, shared))
+            self._conn.execute('UPDATE images SET status = ? WHERE slot = ? AND status = ?', ('superseded', self.slot(output_path), 'ok'))
+            self._conn.execute('INSERT INTO images (prompt, params_hash, requested_seed, seed, info, output_path, slot, reused_from, status, created) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (payload.get('prompt', ''), hash_value, payload.get('seed', -1), seed, info,
+                                relative_path(output_path), self.slot(output_path), reused_from, 'ok', time.time()))
+            self._conn.commit()
+
+    def find_reusable(self, payload):
+        # 随机种子（-1）的请求可以复用同提示词同参数的任意好图；指定了种子的只复用同一种子画出的图
+        hash_value, _ = params_hash(payload)
+        requested_seed = payload.get('seed', -1)
+        with self._lock:
+            rows = self._conn.execute('SELECT id, seed, info, output_path FROM images WHERE prompt = ? AND params_hash = ? AND status = ? ORDER BY id DESC',
+                                      (payload.get('prompt', ''), hash_value, 'ok')).fetchall()
+        for row_id, seed, info, output_path in rows:
+            if requested_seed not in (-1, None) and seed != requested_seed:
+                continue
+            if os.path.exists(os.path.join(ROOT_DIR, output_path)):
+                return {'id': row_id, 'seed': seed, 'info': info, 'output_path': os.path.join(ROOT_DIR, output_path)}
+        return None
+
+    def reject(self, output_path):
+        with self._lock:
+            self._conn.execute('UPDATE images SET status = ? WHERE slot = ? AND status = ?', ('rejected', self.slot(output_path), 'ok'))
+            self._conn.commit()
+
+    def current(self, output_path):
+        # 这个位置上最新一张没被否决的图
+        with self._lock:
+            row = self._conn.execute('SELECT seed, params_hash, prompt FROM images WHERE slot = ? AND status = ? ORDER BY id DESC LIMIT 1',
+                                     (self.slot(output_path), 'ok')).fetchone()
+        return {'seed': row[0], 'params_hash': row[1], 'prompt': row[2]} if row is not None else None
+
+    def last_seed(self, output_path):
+        with self._lock:
+            row = self._conn.execute('SELECT seed FROM images WHERE slot = ? AND seed IS NOT NULL ORDER BY id DESC LIMIT 1', (self.slot(output_path),)).fetchone()
+        return row[0] if row is not None else None
+
+    def attempts(self, payload):
+        hash_value, _ = params_hash(payload)
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM images WHERE prompt = ? AND params_hash = ?', (payload.get('prompt', ''), hash_value)).fetchone()[0]
+
+    def redraw_seed(self, payload, output_path, mode):
+        # pin=沿用这个位置上一张图的种子（改了提示词或参数、想保留构图时用），
+        # vary=按重绘次数确定性地换一个种子，random=交给 WebUI 随机
+        if mode == 'pin':
+            seed = self.last_seed(output_path)
+            return seed if seed is not None else -1
+        if mode == 'vary':
+            return derive_seed(payload.get('prompt', ''), params_hash(payload)[0], self.attempts(payload))
+        return -1
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,63 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+# 大语言模型回复的本地缓存：以模型名、完整消息列表和生成参数的哈希为键，
+# 总大小超过上限时按最近使用时间淘汰最久未用的记录（LRU）。多个线程共用一个实例。
+class LLMCache:
+    def __init__(self, path, max_bytes):
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model, messages, params):
+        source = json.dumps({'model': model, 'messages': messages, 'params': params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE responses SET last_used = ? WHERE key = ?', (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, value):
+        size = len(key) + len(value.encode('utf-8'))
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO responses (key, value, size, last_used) VALUES (?, ?, ?, ?)', (key, value, size, time.time()))
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        while total > self._max_bytes:
+            rows = self._conn.execute('SELECT key, size FROM responses ORDER BY last_used LIMIT 100').fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                total -= size
+                if total <= self._max_bytes:
+                    break
+
+    def summary(self):
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0
+        return f"大语言模型缓存：命中 {self.hits} 次，未命中 {self.misses} 次，命中率 {rate:.1f}%"
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,171 @@
+import os
+import sqlite3
+import threading
+import time
+import argparse
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MANIFEST_PATH = os.path.join(ROOT_DIR, 'txt', 'manifest.db')
+XLSX_PATH = os.path.join(ROOT_DIR, 'txt', 'txt.xlsx')
+
+# 与 txt.xlsx 的 A-D 列一一对应
+XLSX_COLUMNS = ['sentence', 'translation', 'prompt', 'original']
+COLUMNS = XLSX_COLUMNS + ['chapter', 'audio_duration', 'image_path', 'voice_path', 'segment_path']
+
+
+# 各步骤之间交接数据的清单：每句一行，序号 idx 与 image/voice/temp 下的 output_N 一致。
+# 用 SQLite 保存，可以逐行追加、逐行读取和原地更新；txt.xlsx 只作为人工编辑用的导出/导入格式。
+class Manifest:
+    def __init__(self, path=MANIFEST_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS rows (
+            idx INTEGER PRIMARY KEY,
+            sentence TEXT,
+            translation TEXT,
+            prompt TEXT,
+            original TEXT,
+            chapter INTEGER,
+            audio_duration REAL,
+            image_path TEXT,
+            voice_path TEXT,
+            segment_path TEXT)''')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._conn.commit()
+
+    def reset(self):
+        # 重新生成的清单比磁盘上已有的任何表格都新，旧表格（包括自带的空模板）不应再被自动导入
+        with self._lock:
+            self._conn.execute('DELETE FROM rows')
+            self._conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('xlsx_mtime', str(time.time())))
+            self._conn.commit()
+
+    def append_rows(self, rows):
+        # rows 为字典列表，按顺序追加在末尾，返回第一行的序号
+        with self._lock:
+            first = self._conn.execute('SELECT COALESCE(MAX(idx), 0) + 1 FROM rows').fetchone()[0]
+            self._conn.executemany(
+                f"INSERT INTO rows (idx, {', '.join(COLUMNS)}) VALUES (?, {', '.join('?' * len(COLUMNS))})",
+                [(first + i, *(row.get(column) for column in COLUMNS)) for i, row in enumerate(rows)])
+            self._conn.commit()
+            return first
+
+    def update(self, idx, **fields):
+        unknown = set(fields) - set(COLUMNS)
+        if unknown:
+            raise ValueError(f"未知的清单字段：{', '.join(sorted(unknown))}")
+        if not fields:
+            return
+        with self._lock:
+            self._conn.execute(f"UPDATE rows SET {', '.join(f'{name} = ?' for name in fields)} WHERE idx = ?", (*fields.values(), idx))
+            self._conn.commit()
+
+    def get(self, idx):
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM rows WHERE idx = ?', (idx,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def rows(self):
+        with self._lock:
+            return [dict(row) for row in self._conn.execute('SELECT * FROM rows ORDER BY idx')]
+
+    def iter_rows(self, batch_size=500):
+        # 分批读取，不需要一次把整张表读进内存
+        last = 0
+        while True:
+            with self._lock:
+                batch = [dict(row) for row in self._conn.execute('SELECT * FROM rows WHERE idx > ? ORDER BY idx LIMIT ?', (last, batch_size))]
+            if not batch:
+                return
+            yield from batch
+            last = batch[-1]['idx']
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM rows').fetchone()[0]
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+            self._conn.commit()
+
+    def export_xlsx(self, path=XLSX_PATH):
+        import openpyxl
+
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        for row in self.iter_rows():
+            sheet.append([row[column] for column in XLSX_COLUMNS])
+        workbook.save(path)
+        # 记下导出时的修改时间，之后只有人工改过的表格才会被自动导入
+        self.set_meta('xlsx_mtime', os.path.getmtime(path))
+
+    def import_xlsx(self, path=XLSX_PATH):
+        # 按行号把表格 A-D 列写回清单，已有的配图、配音等记录保留；表格行数变少时删除多出的行
+        import openpyxl
+
+        workbook = openpyxl.load_workbook(path, read_only=True)
+        values = [list(row[:len(XLSX_COLUMNS)]) for row in workbook.active.iter_rows(values_only=True)]
+        workbook.close()
+        while values and not any(values[-1]):
+            values.pop()
+
+        with self._lock:
+            for idx, row in enumerate(values, 1):
+                row = row + [None] * (len(XLSX_COLUMNS) - len(row))
+                self._conn.execute(
+                    f"INSERT INTO rows (idx, {', '.join(XLSX_COLUMNS)}) VALUES (?, {', '.join('?' * len(XLSX_COLUMNS))}) "
+                    f"ON CONFLICT(idx) DO UPDATE SET {', '.join(f'{column} = excluded.{column}' for column in XLSX_COLUMNS)}",
+                    (idx, *row))
+            self._conn.execute('DELETE FROM rows WHERE idx > ?', (len(values),))
+            self._conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('xlsx_mtime', str(os.path.getmtime(path))))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def open_manifest(path=MANIFEST_PATH, xlsx_path=XLSX_PATH):
+    # 表格比上次导出/导入时更新（人工编辑过），或者只有旧版本留下的 txt.xlsx 时，先把表格导入清单
+    manifest = Manifest(path)
+    if xlsx_path and os.path.exists(xlsx_path):
+        synced_mtime = float(manifest.get_meta('xlsx_mtime', 0))
+        if os.path.getmtime(xlsx_path) > synced_mtime:
+            print(f"检测到表格有更新，正在导入：{xlsx_path}")
+            manifest.import_xlsx(xlsx_path)
+    return manifest
+
+
+def relative_path(path):
+    return os.path.relpath(path, ROOT_DIR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='文本清单与 txt.xlsx 互相转换')
+    parser.add_argument('action', choices=['export', 'import'], help='export=清单导出为表格，import=表格导入清单')
+    parser.add_argument('--xlsx', type=str, default=XLSX_PATH, help='表格文件路径')
+    parser.add_argument('--manifest', type=str, default=MANIFEST_PATH, help='清单文件路径')
+    args = parser.parse_args()
+
+    manifest = Manifest(args.manifest)
+    if args.action == 'export':
+        manifest.export_xlsx(args.xlsx)
+        print(f"已导出 {len(manifest)} 行到 {args.xlsx}")
+    else:
+        manifest.import_xlsx(args.xlsx)
+        print(f"已从 {args.xlsx} 导入 {len(manifest)} 行")
+    manifest.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,361 @@
+import os
+import json
+import math
+import time
+import uuid
+import bisect
+import argparse
+import threading
+import contextvars
+from contextlib import contextmanager
+import chardet
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_PATH = os.path.join(ROOT_DIR, 'config.json')
+# 同一次运行的编号放在环境变量里，渲染用的子进程启动时会继承
+RUN_ENV = 'MAGIC_TOUCH_RUN'
+
+STAGE_NAMES = {
+    'llm': '大语言模型',
+    'sd': '绘图',
+    'tts': '配音',
+    'render': '视频片段',
+    'concat': '拼接成片',
+}
+
+_lock = threading.Lock()
+_settings = None
+# 当前协程或线程正在处理的行号等附加字段，记录时合并进每条数据
+_scope = contextvars.ContextVar('metrics_scope', default={})
+
+
+def load_settings():
+    global _settings
+    if _settings is None:
+        config = {}
+        if os.path.exists(CONFIG_PATH):
+            with open(CONFIG_PATH, 'rb') as f:
+                encoding = chardet.detect(f.read())['encoding']
+            with open(CONFIG_PATH, 'r', encoding=encoding) as f:
+                config = json.load(f)
+        path = config.get('metrics_file', 'temp/metrics.jsonl')
+        prometheus = config.get('metrics_prometheus', '')
+        _settings = {
+            'path': os.path.join(ROOT_DIR, path) if path else None,
+            'prometheus': os.path.join(ROOT_DIR, prometheus) if prometheus else None,
+        }
+    return _settings
+
+
+def start_run():
+    os.environ[RUN_ENV] = time.strftime('%Y%m%d%H%M%S') + '-' + uuid.uuid4().hex[:6]
+    return os.environ[RUN_ENV]
+
+
+def run_id():
+    return os.environ.get(RUN_ENV) or start_run()
+
+
+def bind(**fields):
+    _scope.set(dict(_scope.get(), **fields))
+
+
+def record(stage, start, duration, **fields):
+    # 每条数据一行 JSON：所属运行、阶段、开始时间（Unix 时间戳）、耗时（秒）和各阶段自己的字段
+    path = load_settings()['path']
+    if not path:
+        return
+    event = {'run': run_id(), 'stage': stage, 'start': round(start, 3), 'duration': round(duration, 4), 'pid': os.getpid()}
+    event.update(_scope.get())
+    event.update(fields)
+    line = json.dumps(event, ensure_ascii=False) + '\n'
+    with _lock:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+
+@contextmanager
+def timer(stage, **fields):
+    # 代码块里可以继续往 fields 里补充字段；抛出异常时记为失败，异常照常向外抛
+    start = time.time()
+    begin = time.perf_counter()
+    fields = dict(fields)
+    try:
+        yield fields
+    except BaseException:
+        fields['ok'] = False
+        raise
+    finally:
+        fields.setdefault('ok', True)
+        record(stage, start, time.perf_counter() - begin, **fields)
+
+
+def proc_rss(pid):
+    with open(f'/proc/{pid}/statm', 'r') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def current_rss():
+    # 本进程加上全部子进程（ffmpeg 编码器等）当前的常驻内存，单位字节；装了 psutil 时用它读取，
+    # 否则在 Linux 上直接读 /proc，其他平台读不到时返回 None
+    if psutil is not None:
+        process = psutil.Process()
+        total = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return total
+    if not os.path.exists('/proc/self/statm'):
+        return None
+    total = proc_rss('self')
+    pending = [os.getpid()]
+    while pending:
+        pid = pending.pop()
+        try:
+            threads = os.listdir(f'/proc/{pid}/task')
+        except OSError:
+            continue
+        for thread in threads:
+            try:
+                with open(f'/proc/{pid}/task/{thread}/children', 'r') as f:
+                    children = [int(child) for child in f.read().split()]
+            except OSError:
+                continue
+            for child in children:
+                try:
+                    total += proc_rss(child)
+                except (OSError, ValueError, IndexError):
+                    continue
+                pending.append(child)
+    return total
+
+
+# 在后台线程里定时采样 current_rss()，记下代码块执行期间的内存峰值（MB），
+# 每个片段单独统计，不受同一进程之前渲染过的片段影响；读不到内存时 peak_mb 为 None
+class MemorySampler:
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        try:
+            value = current_rss()
+        except OSError:
+            return
+        if value is not None:
+            self.peak = max(self.peak or 0, value)
+
+    @property
+    def peak_mb(self):
+        return round(self.peak / 1024 / 1024, 1) if self.peak is not None else None
+
+
+def load_events(path=None, run=None):
+    # run 为空时取文件里最后一次运行的数据
+    path = path or load_settings()['path']
+    if not path or not os.path.exists(path):
+        return []
+    events = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue
+    if not events:
+        return []
+    run = run or events[-1]['run']
+    return [event for event in events if event.get('run') == run]
+
+
+def pad(text, width, right=False):
+    # 中文占两个字符宽度，表格才能对齐
+    spaces = ' ' * max(0, width - sum(2 if ord(c) > 127 else 1 for c in text))
+    return spaces + text if right else text + spaces
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, math.ceil(q * len(values)) - 1))]
+
+
+def summarize(events):
+    stages = {}
+    for event in events:
+        stages.setdefault(event['stage'], []).append(event)
+
+    summary = {}
+    for stage, items in stages.items():
+        durations = [event['duration'] for event in items]
+        summary[stage] = {
+            'count': len(items),
+            'failed': sum(1 for event in items if event.get('ok') is False),
+            'total': sum(durations),
+            'p50': percentile(durations, 0.5),
+            'p95': percentile(durations, 0.95),
+            'max': max(durations),
+        }
+    return summary
+
+
+class EndIndex:
+    # 按结束时间排好序的事件，用二分查找取某个时刻之前结束得最晚的事件
+    def __init__(self, events):
+        self.events = sorted(events, key=lambda event: event['start'] + event['duration'])
+        self.ends = [event['start'] + event['duration'] for event in self.events]
+
+    def latest_before(self, current, tolerance):
+        i = bisect.bisect_right(self.ends, current['start'] + tolerance)
+        # 结束时间落在容差范围内、但开始得比当前事件还晚的不算前驱，跳过
+        while i > 0:
+            i -= 1
+            if self.events[i]['start'] < current['start']:
+                return self.events[i]
+        return None
+
+
+def critical_path(events, tolerance=0.05):
+    # 从最后结束的事件往前倒推：每一步取在它开始之前结束得最晚的事件，同一行的优先，
+    # 得到的链条就是决定总耗时的那条路径，相邻两步之间的空档是排队或等待的时间
+    if not events:
+        return []
+    everything = EndIndex(events)
+    rows = {}
+    for event in events:
+        if 'row' in event:
+            rows.setdefault(event['row'], []).append(event)
+    rows = {row: EndIndex(items) for row, items in rows.items()}
+
+    current = everything.events[-1]
+    path = [current]
+    while True:
+        previous = None
+        if 'row' in current:
+            previous = rows[current['row']].latest_before(current, tolerance)
+        current = previous or everything.latest_before(current, tolerance)
+        if current is None:
+            break
+        path.append(current)
+    path.reverse()
+    return path
+
+
+def report(events):
+    if not events:
+        return "没有性能数据"
+    begin = min(event['start'] for event in events)
+    end = max(event['start'] + event['duration'] for event in events)
+    lines = [f"运行 {events[0]['run']}：共 {len(events)} 条数据，总耗时 {end - begin:.1f} 秒", '']
+    lines.append(pad('阶段', 12) + ''.join(pad(title, width, right=True) for title, width in (('次数', 6), ('失败', 7), ('累计(秒)', 10), ('p50', 9), ('p95', 9), ('最长', 9))))
+    for stage, item in sorted(summarize(events).items(), key=lambda pair: -pair[1]['total']):
+        lines.append(f"{pad(STAGE_NAMES.get(stage, stage), 12)}{item['count']:>6}{item['failed']:>7}{item['total']:>10.1f}{item['p50']:>9.2f}{item['p95']:>9.2f}{item['max']:>9.2f}")
+
+    llm = [event for event in events if event['stage'] == 'llm']
+    if llm:
+        lines.append(f"大语言模型共用 {sum(event.get('total_tokens') or 0 for event in llm)} 个token，重试 {sum(event.get('attempts', 1) - 1 for event in llm)} 次")
+    tts = [event for event in events if event['stage'] == 'tts']
+    if tts:
+        lines.append(f"配音重试 {sum(event.get('attempts', 1) - 1 for event in tts)} 次")
+    renders = [event for event in events if event['stage'] == 'render' and event.get('fps')]
+    if renders:
+        peaks = [event['peak_rss_mb'] for event in renders if event.get('peak_rss_mb')]
+        lines.append(f"视频片段编码速度 p50 {percentile([event['fps'] for event in renders], 0.5):.1f} 帧/秒" +
+                     (f"，单个片段渲染时（含编码进程）内存峰值 p50 {percentile(peaks, 0.5):.0f} MB、最大 {max(peaks):.0f} MB" if peaks else ''))
+
+    lines += ['', '关键路径（从最后完成的步骤往前倒推）：']
+    previous_end = begin
+    totals = {}
+    for event in critical_path(events):
+        wait = event['start'] - previous_end
+        row = f"第 {event['row']} 行" if 'row' in event else ''
+        lines.append(f"  +{event['start'] - begin:8.1f}s  {pad(STAGE_NAMES.get(event['stage'], event['stage']), 12)}{pad(row, 12)}耗时 {event['duration']:7.2f}s" +
+                     (f"  之前等待 {wait:.2f}s" if wait > 0.05 else ''))
+        totals[event['stage']] = totals.get(event['stage'], 0) + event['duration']
+        previous_end = event['start'] + event['duration']
+    if totals:
+        lines.append('  关键路径上各阶段合计：' + '，'.join(f"{STAGE_NAMES.get(stage, stage)} {seconds:.1f}s" for stage, seconds in totals.items()))
+    return '\n'.join(lines)
+
+
+def write_prometheus(events, path):
+    # node_exporter textfile 格式；先写临时文件再改名，采集时不会读到写了一半的文件
+    lines = [
+        '# HELP magic_touch_stage_seconds Duration of each pipeline stage in the latest run.',
+        '# TYPE magic_touch_stage_seconds summary',
+    ]
+    summary = summarize(events)
+    for stage, item in sorted(summary.items()):
+        lines.append(f'magic_touch_stage_seconds{{stage="{stage}",quantile="0.5"}} {item["p50"]}')
+        lines.append(f'magic_touch_stage_seconds{{stage="{stage}",quantile="0.95"}} {item["p95"]}')
+        lines.append(f'magic_touch_stage_seconds_sum{{stage="{stage}"}} {round(item["total"], 4)}')
+        lines.append(f'magic_touch_stage_seconds_count{{stage="{stage}"}} {item["count"]}')
+    lines += ['# HELP magic_touch_stage_failures Failed operations per stage in the latest run.', '# TYPE magic_touch_stage_failures gauge']
+    lines += [f'magic_touch_stage_failures{{stage="{stage}"}} {item["failed"]}' for stage, item in sorted(summary.items())]
+    lines += ['# HELP magic_touch_llm_tokens Tokens used by LLM requests in the latest run.', '# TYPE magic_touch_llm_tokens gauge',
+              f'magic_touch_llm_tokens {sum(event.get("total_tokens") or 0 for event in events if event["stage"] == "llm")}']
+    peaks = [event['peak_rss_mb'] for event in events if event.get('peak_rss_mb')]
+    if peaks:
+        lines += ['# HELP magic_touch_render_peak_rss_bytes Largest per-segment peak RSS (renderer plus encoder) in the latest run.', '# TYPE magic_touch_render_peak_rss_bytes gauge',
+                  f'magic_touch_render_peak_rss_bytes {int(max(peaks) * 1024 * 1024)}']
+    if events:
+        wall = max(event['start'] + event['duration'] for event in events) - min(event['start'] for event in events)
+        lines += ['# HELP magic_touch_run_seconds Wall-clock time of the latest run.', '# TYPE magic_touch_run_seconds gauge',
+                  f'magic_touch_run_seconds {round(wall, 3)}']
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8', newline='\n') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(path + '.tmp', path)
+
+
+def finish_run(show_report=False):
+    settings = load_settings()
+    if not settings['path']:
+        return
+    events = load_events(run=run_id())
+    if settings['prometheus'] and events:
+        write_prometheus(events, settings['prometheus'])
+    if show_report and events:
+        print(report(events))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='性能数据报告：各阶段耗时的 p50/p95 和关键路径')
+    parser.add_argument('--run', type=str, default=None, help='运行编号，不填时取最后一次运行')
+    parser.add_argument('--file', type=str, default=None, help='性能数据文件，默认为配置文件中的 metrics_file')
+    parser.add_argument('--prometheus', type=str, default=None, help='同时导出为 Prometheus textfile 格式')
+    args = parser.parse_args()
+
+    events = load_events(args.file, args.run)
+    print(report(events))
+    if args.prometheus and events:
+        write_prometheus(events, args.prometheus)
+
+
+if __name__ == '__main__':
+    main()
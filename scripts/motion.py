@@ -0,0 +1,122 @@
+import numpy as np
+from PIL import Image
+
+CROP_RATIO = 0.8
+
+
+def transform_image(img, t, x_speed, y_speed, move_on_x, move_positive):
+    original_size = img.size
+
+    crop_width = img.width * CROP_RATIO
+    crop_height = img.height * CROP_RATIO
+    if move_on_x:
+        left = min(x_speed * t, img.width - crop_width) if move_positive else max(img.width - crop_width - x_speed * t, 0)
+        upper = (img.height - crop_height) / 2
+    else:
+        upper = min(y_speed * t, img.height - crop_height) if move_positive else max(img.height - crop_height - y_speed * t, 0)
+        left = (img.width - crop_width) / 2
+
+    right = left + crop_width
+    lower = upper + crop_height
+
+    cropped_img = img.crop((left, upper, right, lower))
+
+    return cropped_img.resize(original_size)
+
+
+def plan_crop_windows(width, height, n_frames, fps, x_speed, y_speed, move_on_x, move_positive):
+    # 一次算出整段所有帧的裁剪框左上角，公式与 transform_image 完全一致
+    t = np.arange(n_frames, dtype=np.float64) / fps
+    crop_width = width * CROP_RATIO
+    crop_height = height * CROP_RATIO
+
+    if move_on_x:
+        if move_positive:
+            left = np.minimum(x_speed * t, width - crop_width)
+        else:
+            left = np.maximum(width - crop_width - x_speed * t, 0)
+        upper = np.full(n_frames, (height - crop_height) / 2)
+    else:
+        if move_positive:
+            upper = np.minimum(y_speed * t, height - crop_height)
+        else:
+            upper = np.maximum(height - crop_height - y_speed * t, 0)
+        left = np.full(n_frames, (width - crop_width) / 2)
+
+    return left, upper
+
+
+# 裁剪框大小固定，所以整张图只按 1/CROP_RATIO 放大一次，之后每一帧只是从放大图里
+# 按预先算好的偏移取一块写进复用的输出缓冲区，不再逐帧 crop + resize。
+# smooth=True 时在运镜方向上相邻的两个整像素窗口之间线性插值，实现亚像素平滑移动。
+# render() 默认写入内部缓冲区，返回的数组会被下一次调用覆盖，需要保留时请自行 copy；
+# 也可以通过 out 直接写进调用方的数组（例如合成画布中前景所在的区域）。
+class KenBurnsRenderer:
+    def __init__(self, img, n_frames, fps, x_speed, y_speed, move_on_x, move_positive, smooth=False):
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        self.size = img.size
+        self.n_frames = n_frames
+        self.fps = fps
+        self.smooth = smooth
+
+        width, height = img.size
+        scaled_width = round(width / CROP_RATIO)
+        scaled_height = round(height / CROP_RATIO)
+        self._scaled = np.asarray(img.resize((scaled_width, scaled_height), Image.BICUBIC))
+
+        left, upper = plan_crop_windows(width, height, n_frames, fps, x_speed, y_speed, move_on_x, move_positive)
+        offset_x = np.clip(left * scaled_width / width, 0, scaled_width - width)
+        offset_y = np.clip(upper * scaled_height / height, 0, scaled_height - height)
+
+        self._move_on_x = move_on_x
+        moving, fixed = (offset_x, offset_y) if move_on_x else (offset_y, offset_x)
+        fixed = np.rint(fixed).astype(np.intp)
+        if smooth:
+            self._weights = (moving - np.floor(moving)).astype(np.float32)
+            moving = np.floor(moving).astype(np.intp)
+            self._acc = np.empty((height, width, 3), dtype=np.float32)
+            self._tmp = np.empty((height, width, 3), dtype=np.float32)
+        else:
+            moving = np.rint(moving).astype(np.intp)
+        self._x, self._y = (moving, fixed) if move_on_x else (fixed, moving)
+
+        self._out = np.empty((height, width, 3), dtype=np.uint8)
+
+    def __len__(self):
+        return self.n_frames
+
+    def _window(self, x, y):
+        width, height = self.size
+        return self._scaled[y:y + height, x:x + width]
+
+    def render(self, frame_index, out=None):
+        if out is None:
+            out = self._out
+        x = self._x[frame_index]
+        y = self._y[frame_index]
+
+        if not self.smooth:
+            np.copyto(out, self._window(x, y))
+            return out
+
+        weight = self._weights[frame_index]
+        if weight == 0:
+            np.copyto(out, self._window(x, y))
+            return out
+
+        next_window = self._window(x + 1, y) if self._move_on_x else self._window(x, y + 1)
+
+        np.multiply(self._window(x, y), 1 - weight, out=self._acc)
+        np.multiply(next_window, weight, out=self._tmp)
+        np.add(self._acc, self._tmp, out=self._acc)
+        np.add(self._acc, 0.5, out=self._acc)
+        np.copyto(out, self._acc, casting='unsafe')
+        return out
+
+    def frame_index(self, t):
+        return min(int(round(t * self.fps)), self.n_frames - 1)
+
+    def make_frame(self, t):
+        return self.render(self.frame_index(t))
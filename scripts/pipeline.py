@@ -0,0 +1,212 @@
+import os
+import argparse
+import asyncio
+import importlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from tqdm import tqdm
+from manifest import Manifest, open_manifest, relative_path, MANIFEST_PATH
+from sd_client import SDClient, parse_addresses
+from generation_ledger import GenerationLedger
+import step1_extract_keywords as step1
+import step2_txt_to_image as step2
+import step4_output_video as step4
+import metrics
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+VOICE_SCRIPTS = {
+    'free': 'step3_txt_to_voice_free',
+    'azure': 'step3_txt_to_voice',
+}
+
+
+# 流水线：每一行文本是一个小的依赖图 —— 提示词 → 图片、原文 → 配音、图片 + 配音 → 视频片段，
+# 全部片段完成后再拼接成片。文字处理每完成一章就放出该章的行，绘图、配音、渲染各有自己的并发上限，
+# 同时处理不同的行，总耗时接近最慢的那一步，而不是四步相加。
+class Pipeline:
+    def __init__(self, config, manifest, preview=False, language='zh-CN'):
+        self.config = config
+        self.manifest = manifest
+        self.preview = preview
+        self.language = language
+
+        self.image_dir = os.path.join(ROOT_DIR, 'image')
+        self.voice_dir = os.path.join(ROOT_DIR, 'voice')
+        self.video_dir = os.path.join(ROOT_DIR, 'video')
+        for directory in (self.image_dir, self.voice_dir, self.video_dir):
+            os.makedirs(directory, exist_ok=True)
+
+        cloud_address, more_details, data = step2.get_cloud_address()
+        self.image_addresses = parse_addresses(cloud_address or "http://127.0.0.1:7860")
+        self.image_max_in_flight, self.image_timeout = step2.get_sd_options()
+        self.image_options = step2.get_draw_options()
+        self.more_details = more_details
+        # 流水线里没有人工检查草图的环节，直接按完整参数绘制
+        self.payload = step2.build_payload(data, self.image_options['profile'])
+
+        self.voice_engine = config.get('pipeline_voice', 'free')
+        self.voice_module = importlib.import_module(VOICE_SCRIPTS[self.voice_engine])
+        self.voice_provider = self.voice_module.SpeechProvider() if self.voice_engine == 'azure' else None
+
+        self.settings, self.output_name = step4.build_settings(config, ROOT_DIR, preview)
+        self.render_cache = config.get('render_cache', True)
+        self.voice_concurrency = max(1, int(config.get('pipeline_voice_concurrency', 4)))
+        self.render_workers = int(config.get('render_workers', 1)) or os.cpu_count() or 1
+
+    async def run(self, skip_text=False):
+        loop = asyncio.get_running_loop()
+        # asyncio 的信号量要在事件循环里创建
+        self.voice_semaphore = asyncio.Semaphore(self.voice_concurrency)
+        self.render_semaphore = asyncio.Semaphore(self.render_workers)
+        self.render_executor = ProcessPoolExecutor(max_workers=self.render_workers)
+        self.render_threads = max(1, (os.cpu_count() or 1) // self.render_workers)
+        os.makedirs(os.path.dirname(step2.ledger_path), exist_ok=True)
+        self.ledger = GenerationLedger(step2.ledger_path)
+
+        self.row_tasks = []
+        self.bars = {
+            'image': tqdm(total=0, desc='绘图', unit='image', position=0),
+            'voice': tqdm(total=0, desc='配音', unit='file', position=1),
+            'segment': tqdm(total=0, desc='视频片段', unit='clip', position=2),
+        }
+
+        # 绘图的并发由绘图池按每台后端的上限控制
+        async with SDClient(self.image_addresses, self.image_max_in_flight, self.image_timeout) as self.sd_client:
+            try:
+                if skip_text:
+                    rows = self.manifest.rows()
+                    if rows:
+                        self.schedule_rows(rows[0]['idx'], len(rows))
+                else:
+                    # 文字处理在线程里运行，每完成一章通过回调把新行交回事件循环
+                    on_rows = lambda first_row, count: loop.call_soon_threadsafe(self.schedule_rows, first_row, count)
+                    await loop.run_in_executor(None, step1.extract_text, self.config, self.manifest, on_rows)
+
+                results = await asyncio.gather(*self.row_tasks)
+            finally:
+                for bar in self.bars.values():
+                    bar.close()
+                self.render_executor.shutdown()
+                self.ledger.close()
+                if self.voice_provider is not None:
+                    self.voice_provider.close()
+
+        indices = [index for index in results if index is not None]
+        if not indices:
+            print("没有可以合成的视频片段")
+            return None
+
+        temp_filenames = [step4.segment_paths(self.settings, index)[0] for index in indices]
+        durations = [step4.read_segment_record(self.settings, index).get('duration') for index in indices]
+        output_file = os.path.join(self.video_dir, f'{self.output_name}_{datetime.now().strftime("%Y%m%d%H%M%S")}.mp4')
+        return step4.concatenate_segments(temp_filenames, output_file, durations)
+
+    def schedule_rows(self, first_row, count):
+        for idx in range(first_row, first_row + count):
+            self.row_tasks.append(asyncio.ensure_future(self.process_row(idx)))
+        for bar in self.bars.values():
+            bar.total += count
+            bar.refresh()
+
+    async def process_row(self, idx):
+        # 每行是单独的任务，行号只绑定在这个任务里，绘图和配音的性能数据都会带上
+        metrics.bind(row=idx)
+        row = self.manifest.get(idx)
+        image_ready, voice_ready = await asyncio.gather(self.make_image(row), self.make_voice(row))
+        if not (image_ready and voice_ready):
+            self.bars['segment'].update(1)
+            return None
+        return await self.make_segment(idx)
+
+    async def make_image(self, row):
+        idx = row['idx']
+        try:
+            if not row['prompt']:
+                return False
+            # 与单独运行绘图脚本一样，已有的图片不重画
+            if step4.find_image(self.image_dir, idx):
+                return True
+
+            output_path = os.path.join(self.image_dir, f'output_{idx}.png')
+            payload = dict(self.payload, prompt=f"{row['prompt']},{self.more_details}")
+            output_path = await step2.produce_image(self.sd_client, self.ledger, payload, output_path, self.image_options)
+            self.manifest.update(idx, image_path=relative_path(output_path))
+            return True
+        except Exception as e:
+            tqdm.write(f"序号 {idx} 的图片生成失败：{str(e)}")
+            return False
+        finally:
+            self.bars['image'].update(1)
+
+    async def make_voice(self, row):
+        idx = row['idx']
+        try:
+            if not row['original']:
+                return False
+            # 本次清单里已经配过音的行（中断后重新运行时）直接复用
+            if row['voice_path'] and os.path.exists(os.path.join(ROOT_DIR, row['voice_path'])):
+                return True
+
+            async with self.voice_semaphore:
+                if self.voice_engine == 'azure':
+                    output_path = os.path.join(self.voice_dir, f'output_{idx}.wav')
+                    result = await self.voice_module.synthesize_to_file(self.voice_provider, row['original'], self.language, idx, self.voice_dir)
+                    if result['error']:
+                        raise Exception(result['error'])
+                    self.manifest.update(idx, voice_path=relative_path(output_path), audio_duration=result['duration'])
+                    return True
+
+                config_file = os.path.join(ROOT_DIR, 'config.json')
+                converted = await self.voice_module.convert_text_to_audio(row['original'], self.language, self.voice_dir, idx, config_file)
+                if converted:
+                    self.manifest.update(idx, voice_path=relative_path(converted['output_path']), audio_duration=converted['duration'])
+                return bool(converted)
+        except Exception as e:
+            tqdm.write(f"序号 {idx} 的配音生成失败：{str(e)}")
+            return False
+        finally:
+            self.bars['voice'].update(1)
+
+    async def make_segment(self, idx):
+        loop = asyncio.get_running_loop()
+        try:
+            plan = await loop.run_in_executor(None, step4.plan_segment, idx, self.settings)
+            if not (self.render_cache and step4.is_segment_cached(plan, self.settings)):
+                async with self.render_semaphore:
+                    await loop.run_in_executor(self.render_executor, step4.render_segment, plan, self.settings, None, self.render_threads, None)
+            if not self.preview:
+                self.manifest.update(idx, segment_path=relative_path(step4.segment_paths(self.settings, idx)[0]))
+            return idx
+        except Exception as e:
+            tqdm.write(f"序号 {idx} 的视频片段生成失败：{str(e)}")
+            return None
+        finally:
+            self.bars['segment'].update(1)
+
+
+def main():
+    print("软件作者：西装革律")
+    print("禁止倒卖，违者必究！")
+    print("交流群：797579852")
+
+    parser = argparse.ArgumentParser(description='一键流水线：文字处理、绘图、配音、视频合成同时进行')
+    parser.add_argument('--skip_text', action='store_true', help='跳过文字处理，直接使用现有的文本清单（人工改过的 txt.xlsx 会先导入）')
+    parser.add_argument('--preview', action='store_true', help='视频部分按预览参数渲染')
+    parser.add_argument('--language', type=str, default="zh-CN", help='文本的语言')
+    args = parser.parse_args()
+
+    # 渲染子进程启动前确定运行编号，子进程的性能数据才会归到同一次运行
+    metrics.start_run()
+    config = step4.get_config()
+    manifest = open_manifest() if args.skip_text else Manifest(MANIFEST_PATH)
+    pipeline = Pipeline(config, manifest, preview=args.preview, language=args.language)
+    output_file = asyncio.run(pipeline.run(skip_text=args.skip_text))
+    manifest.close()
+    if output_file:
+        print(f"视频已生成：{output_file}")
+    metrics.finish_run(show_report=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import random
+import threading
+import time
+
+
+def backoff_delay(attempt, base=1, cap=60):
+    # 指数退避加全量随机抖动，避免大量并发请求在同一时刻一起重试
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def estimate_tokens(messages, max_tokens):
+    # 没有分词器时的粗略估算：英文约 4 个字符一个 token，中文等非 ASCII 字符按一字一个 token，
+    # 再加上每条消息的固定开销和本次允许生成的最大 token 数
+    tokens = 0
+    for message in messages:
+        content = message.get('content') or ''
+        ascii_chars = sum(1 for c in content if ord(c) < 128)
+        tokens += ascii_chars // 4 + (len(content) - ascii_chars) + 4
+    return tokens + max_tokens
+
+
+class TokenBucket:
+    def __init__(self, per_minute, burst, minimum=1):
+        # 桶容量只占每分钟额度的一小部分，回填速度扣掉这部分：任意 60 秒内 容量 + 回填 不超过额度
+        self.capacity = min(float(per_minute), max(minimum, per_minute * burst))
+        self.rate = max(per_minute - self.capacity, per_minute * (1 - burst)) / 60
+        self.level = self.capacity
+
+    def refill(self, elapsed):
+        self.level = min(self.capacity, self.level + elapsed * self.rate)
+
+    def wait_time(self, amount):
+        # 超过桶容量的请求等桶满后放行，多扣的部分记为欠额，之后的请求要等它回填完
+        need = min(amount, self.capacity)
+        # 回填按浮点数累加，差一点点也算够，避免反复等待极短的时间
+        if self.level >= need - 1e-6:
+            return 0
+        return (need - self.level) / self.rate
+
+
+# 同时按每分钟请求数（RPM）和每分钟 token 数（TPM）限流的令牌桶，多个线程共用一个实例。
+# 两个桶都按时间匀速回填，发请求前先扣额度，额度不够就等到够为止，保证不超过服务商的限额。
+# burst 为允许一次性用掉的额度比例，桶一开始是满的，所以刚启动时不会在第一分钟里用掉两倍的额度。
+class RateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute, burst=0.1):
+        self._requests = TokenBucket(requests_per_minute, burst)
+        self._tokens = TokenBucket(tokens_per_minute, burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests.refill(elapsed)
+        self._tokens.refill(elapsed)
+
+    def acquire(self, tokens):
+        while True:
+            with self._lock:
+                self._refill()
+                wait = max(self._requests.wait_time(1), self._tokens.wait_time(tokens))
+                if wait <= 0:
+                    self._requests.level -= 1
+                    self._tokens.level -= tokens
+                    return
+            time.sleep(wait)
+
+    def settle(self, estimated, actual):
+        # 实际用量超出预估时补扣差额；预估偏多的部分不退回，因为服务商同样按 max_tokens 预扣
+        if actual > estimated:
+            with self._lock:
+                self._refill()
+                self._tokens.level -= actual - estimated
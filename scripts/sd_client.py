@@ -0,0 +1,237 @@
+import os
+import re
+import json
+import time
+import base64
+import asyncio
+import aiohttp
+from rate_limiter import backoff_delay
+import metrics
+
+# 回复中 images 数组第一个字符串的开头
+IMAGES_KEY = re.compile(rb'(?<!\\)"images"\s*:\s*\[\s*"')
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class SDError(Exception):
+    pass
+
+
+def parse_addresses(cloud_address):
+    # cloud_address 可以是单个地址、逗号分隔的多个地址，或者地址列表
+    if not cloud_address:
+        return []
+    if isinstance(cloud_address, str):
+        cloud_address = cloud_address.replace('，', ',').split(',')
+    return [address.strip().rstrip('/') for address in cloud_address if address and address.strip()]
+
+
+# 边接收边解码：第一张图的 base64 按 4 字节对齐分段解码后直接写入文件，不在内存里保留整段字符串；
+# 其余 JSON（parameters、info 等）体积很小，照常收集后解析，图片位置留空字符串
+class ImageStreamDecoder:
+    def __init__(self, file):
+        self._file = file
+        self._state = 'scan'
+        self._rest = bytearray()
+        self._carry = b''
+
+    def feed(self, chunk):
+        if self._state == 'scan':
+            self._rest += chunk
+            match = IMAGES_KEY.search(self._rest)
+            if not match:
+                return
+            chunk = bytes(self._rest[match.end():])
+            del self._rest[match.end():]
+            self._state = 'image'
+
+        if self._state == 'image':
+            end = chunk.find(b'"')
+            # base64 字符里没有反斜杠，去掉 JSON 转义（\/）即可
+            self._write((chunk if end < 0 else chunk[:end]).replace(b'\\', b''))
+            if end < 0:
+                return
+            if self._carry:
+                self._file.write(base64.b64decode(self._carry + b'=' * (-len(self._carry) % 4)))
+                self._carry = b''
+            chunk = chunk[end:]
+            self._state = 'rest'
+
+        self._rest += chunk
+
+    def _write(self, data):
+        data = self._carry + data
+        aligned = len(data) - len(data) % 4
+        if aligned:
+            self._file.write(base64.b64decode(data[:aligned]))
+        self._carry = data[aligned:]
+
+    def result(self):
+        if self._state != 'rest':
+            raise SDError("回复中没有完整的图片数据")
+        return json.loads(bytes(self._rest))
+
+
+class Backend:
+    def __init__(self, address, max_in_flight):
+        self.address = address
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.healthy = True
+        self.completed = 0
+        self.failed = 0
+
+    @property
+    def load(self):
+        return self.in_flight / self.max_in_flight
+
+
+# 多台 WebUI 组成的绘图池：每个后端同时最多 max_in_flight 个 txt2img 任务，
+# 新任务交给当前负载最低的健康后端；请求失败的任务换一个后端重新排队，
+# 连不上的后端暂时摘除，后台定期用 /sdapi/v1/progress 检查，恢复后重新参与分配。
+class SDClient:
+    def __init__(self, addresses, max_in_flight=1, timeout=600, health_interval=15, max_attempts=None):
+        if not addresses:
+            raise ValueError("未提供Stable Diffusion地址")
+        self.backends = [Backend(address, max(1, max_in_flight)) for address in addresses]
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._health_interval = health_interval
+        self._max_attempts = max_attempts or len(self.backends) * 2 + 1
+        self._session = None
+        self._condition = None
+        self._health_task = None
+
+    async def __aenter__(self):
+        self._session = aiohttp.ClientSession(timeout=self._timeout)
+        self._condition = asyncio.Condition()
+        await self.check_health()
+        self._health_task = asyncio.ensure_future(self._watch_health())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._health_task.cancel()
+        try:
+            await self._health_task
+        except asyncio.CancelledError:
+            pass
+        await self._session.close()
+
+    @property
+    def capacity(self):
+        return sum(backend.max_in_flight for backend in self.backends)
+
+    async def _probe(self, backend):
+        try:
+            async with self._session.get(backend.address + '/sdapi/v1/progress', params={'skip_current_image': 'true'},
+                                         timeout=aiohttp.ClientTimeout(total=10)) as response:
+                return response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    async def check_health(self):
+        results = await asyncio.gather(*(self._probe(backend) for backend in self.backends))
+        async with self._condition:
+            for backend, healthy in zip(self.backends, results):
+                backend.healthy = healthy
+            self._condition.notify_all()
+        return results
+
+    async def _watch_health(self):
+        while True:
+            await asyncio.sleep(self._health_interval)
+            if not all(backend.healthy for backend in self.backends):
+                await self.check_health()
+
+    async def _acquire(self, tried):
+        # 优先选这个任务还没失败过的后端；全部健康后端都试过时不再排除。没有健康后端时返回 None
+        async with self._condition:
+            while True:
+                healthy = [backend for backend in self.backends if backend.healthy]
+                if not healthy:
+                    return None
+                pool = [backend for backend in healthy if backend.address not in tried] or healthy
+                free = [backend for backend in pool if backend.in_flight < backend.max_in_flight]
+                if free:
+                    backend = min(free, key=lambda backend: backend.load)
+                    backend.in_flight += 1
+                    return backend
+                await self._condition.wait()
+
+    async def _release(self, backend):
+        async with self._condition:
+            backend.in_flight -= 1
+            self._condition.notify_all()
+
+    async def _read_response(self, response, image_path):
+        if image_path is None:
+            return await response.json()
+
+        # 先写入临时文件，完整收到后再改名，中途失败不会留下半张图
+        part_path = image_path + '.part'
+        try:
+            with open(part_path, 'wb') as f:
+                decoder = ImageStreamDecoder(f)
+                async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    decoder.feed(chunk)
+                result = decoder.result()
+            os.replace(part_path, image_path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        return result
+
+    async def txt2img(self, payload, image_path=None):
+        # 给出 image_path 时第一张图边下载边写入该文件，返回的结果里 images[0] 为空字符串
+        # 性能数据：queue 为等待空闲后端的时间，latency 为最后一次请求本身的耗时
+        start = time.time()
+        begin = time.perf_counter()
+        queued = 0
+        tried = set()
+        last_error = None
+        for attempt in range(self._max_attempts):
+            acquire_start = time.perf_counter()
+            backend = await self._acquire(tried)
+            queued += time.perf_counter() - acquire_start
+            if backend is None:
+                # 所有后端都连不上：退避一段时间后重新检查
+                last_error = SDError("没有可用的Stable Diffusion后端")
+                await asyncio.sleep(backoff_delay(attempt))
+                await self.check_health()
+                continue
+
+            rejected = None
+            request_start = time.perf_counter()
+            try:
+                async with self._session.post(backend.address + '/sdapi/v1/txt2img', json=payload) as response:
+                    if 400 <= response.status < 500:
+                        # 参数错误，换后端也不会成功，不再重试
+                        rejected = SDError(f"{backend.address} 拒绝了请求（{response.status}）：{await response.text()}")
+                    elif response.status != 200:
+                        raise SDError(f"{backend.address} 返回错误：{response.status}")
+                    else:
+                        result = await self._read_response(response, image_path)
+                        backend.completed += 1
+                        metrics.record('sd', start, time.perf_counter() - begin, queue=round(queued, 3), latency=round(time.perf_counter() - request_start, 3),
+                                       attempts=attempt + 1, backend=backend.address, ok=True)
+                        return result
+            except (SDError, ValueError) as e:
+                backend.failed += 1
+                tried.add(backend.address)
+                last_error = e
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                backend.failed += 1
+                backend.healthy = False
+                tried.add(backend.address)
+                last_error = SDError(f"{backend.address} 连接失败：{str(e) or type(e).__name__}")
+            finally:
+                await self._release(backend)
+
+            if rejected is not None:
+                metrics.record('sd', start, time.perf_counter() - begin, queue=round(queued, 3), attempts=attempt + 1, backend=backend.address, ok=False)
+                raise rejected
+
+        metrics.record('sd', start, time.perf_counter() - begin, queue=round(queued, 3), attempts=self._max_attempts, ok=False)
+        raise SDError(f"已重试 {self._max_attempts} 次仍然失败：{last_error}")
+
+    def summary(self):
+        return '\n'.join(f"{backend.address}：完成 {backend.completed} 张，失败 {backend.failed} 次" for backend in self.backends)
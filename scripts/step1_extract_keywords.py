@@ -1,4 +1,8 @@
 import os
+import re
+import glob
+import zipfile
+import xml.etree.ElementTree as ET
 import openpyxl
 import spacy
 import openai
@@ -8,9 +12,25 @@ import chardet
 from docx import Document
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
+from rate_limiter import RateLimiter, backoff_delay, estimate_tokens
+from llm_cache import LLMCache
+from manifest import Manifest, MANIFEST_PATH
+import metrics
 
 openai.api_key = os.getenv('OPENAI_API_KEY')
-nlp = spacy.load('zh_core_web_sm')
+nlp = None
+rate_limiter = RateLimiter(60, 60000)
+llm_cache = None
+
+MODEL = "gpt-3.5-turbo-16k"      #这里同样需要改为你本地部署的大语言模型名称
+
+WORD_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+CHAPTER_PATTERN = r'^\s*(?:第\s*[0-9０-９零〇一二两三四五六七八九十百千万]+\s*[章节回卷集部篇]|序章|序言|楔子|引子|尾声|后记|番外)'
+
+TRANSLATION_RULES = "Do not directly translate, but instead translate from a third-person descriptive perspective, and complete the missing subject, predicate, object, attributive, adverbial, and complement in the text."
+STORYBOARD_SYSTEM_PROMPT = "StableDiffusion is a deep learning text-to-image model that supports the generation of new images using keywords to describe the elements to be included or omitted. Now, as a professional StableDiffusion AI drawing keyword generator. You can assist me in generating keywords for my desired image."
+# 批量模式下每条句子预留的回复 token 数（译文 + 提示词）
+BATCH_TOKENS_PER_ITEM = 400
 
 def load_config():
     current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -23,11 +43,52 @@ def load_config():
     with open(config_file, 'r', encoding=encoding) as f:
         return json.load(f)
 
-def replace_keywords(sentence, keyword_dict):
-    original_sentence = sentence
-    for key, value in keyword_dict.items():
-        sentence = sentence.replace(key, value)
-    return sentence, original_sentence
+def load_keyword_dict(config):
+    # 角色名、角色名2、角色名3……数量不限，对应的特征为 特征、特征2、特征3……；名字或特征为空的槽位跳过
+    keyword_dict = {}
+    for key, value in config.items():
+        match = re.fullmatch(r'角色名(\d*)', key)
+        if not match or not isinstance(value, str) or not value.strip():
+            continue
+        feature = config.get(f'特征{match.group(1)}')
+        if isinstance(feature, str) and feature.strip():
+            keyword_dict[value.strip()] = feature.strip()
+    return keyword_dict
+
+def build_trie_pattern(words):
+    # 把所有角色名建成前缀树再转成正则：同一位置只需沿树走一遍，而且总是优先匹配更长的名字
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def to_pattern(node):
+        branches = [re.escape(char) + to_pattern(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            return '(?:' + pattern + ')?'
+        return pattern
+
+    return re.compile(to_pattern(trie))
+
+# 所有角色名编译成一个正则，每句只扫描一遍：从左到右找到最先出现、且在该位置最长的角色名替换掉。
+# 替换进去的特征文字不会再被别的角色名二次匹配，结果也与角色名在配置里的先后顺序无关。
+class KeywordReplacer:
+    def __init__(self, keyword_dict):
+        self._mapping = {key: value for key, value in keyword_dict.items() if key}
+        self._pattern = build_trie_pattern(self._mapping) if self._mapping else None
+
+    def replace(self, sentence):
+        if self._pattern is None:
+            return sentence
+        return self._pattern.sub(lambda match: self._mapping[match.group(0)], sentence)
+
+def replace_keywords(sentence, replacer):
+    return replacer.replace(sentence), sentence
 
 def merge_short_sentences(sentences, min_length):
     merged_sentences = []
@@ -47,123 +108,354 @@ def merge_short_sentences(sentences, min_length):
 
     return merged_sentences
 
+def retry_after_seconds(error):
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
 def request_with_retry(messages, max_tokens=500, max_requests=90, cooldown_seconds=60):
+    cache_key = None
+    if llm_cache is not None:
+        cache_key = LLMCache.make_key(MODEL, messages, {'max_tokens': max_tokens, 'n': 1, 'stop': None, 'api_base': openai.api_base})
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    estimated_tokens = estimate_tokens(messages, max_tokens)
+    start = time.time()
+    begin = time.perf_counter()
+    attempt = 0
     while True:
+        rate_limiter.acquire(estimated_tokens)
         try:
+            request_start = time.perf_counter()
             response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo-16k",      #这里同样需要改为你本地部署的大语言模型名称
+                model=MODEL,
                 messages=messages,
                 max_tokens=max_tokens,
                 n=1,
                 stop=None,
                 #api_base="http://127.0.0.1:8000",如果需要使用本地部署的大语言模型，自行修改这行的参数
             )
-            return response['choices'][0]['message']['content'].strip()
-        except openai.error.RateLimitError:
-            print("超过速率限制。正在等待冷却时间...")
-            time.sleep(cooldown_seconds)
+            content = response['choices'][0]['message']['content'].strip()
+            latency = time.perf_counter() - request_start
+            break
+        except openai.error.RateLimitError as e:
+            delay = retry_after_seconds(e) or backoff_delay(attempt, base=2, cap=cooldown_seconds)
+            print(f"超过速率限制，{delay:.1f} 秒后重试...")
         except Exception as e:
-            print(f"发生错误：{str(e)}")
-            time.sleep(10)
+            delay = backoff_delay(attempt, base=1, cap=cooldown_seconds)
+            print(f"发生错误：{str(e)}，{delay:.1f} 秒后重试...")
+        time.sleep(delay)
+        attempt += 1
+
+    # 请求已经成功并计费，之后的记账出错只打印提示，不能再重新请求
+    try:
+        usage = response.get('usage') or {}
+        rate_limiter.settle(estimated_tokens, usage.get('total_tokens', 0))
+        metrics.record('llm', start, time.perf_counter() - begin, latency=round(latency, 3), attempts=attempt + 1,
+                       prompt_tokens=usage.get('prompt_tokens'), completion_tokens=usage.get('completion_tokens'), total_tokens=usage.get('total_tokens'))
+        if cache_key is not None:
+            llm_cache.put(cache_key, content)
+    except Exception as e:
+        print(f"记录请求结果时出错：{str(e)}")
+    return content
 
 def translate_to_english(text):
     messages = [
         {"role": "system", "content": "You are a helpful assistant."},
-        {"role": "user", "content": f"Translate the following text into English: \"{text}\". Do not directly translate, but instead translate from a third-person descriptive perspective, and complete the missing subject, predicate, object, attributive, adverbial, and complement in the text. Besides the translated result, do not include any irrelevant content or explanations in your response."},
+        {"role": "user", "content": f"Translate the following text into English: \"{text}\". {TRANSLATION_RULES} Besides the translated result, do not include any irrelevant content or explanations in your response."},
     ]
     return request_with_retry(messages)
 
 def translate_to_storyboard(text, trigger):
     messages = [
-        {"role": "system", "content": "StableDiffusion is a deep learning text-to-image model that supports the generation of new images using keywords to describe the elements to be included or omitted. Now, as a professional StableDiffusion AI drawing keyword generator. You can assist me in generating keywords for my desired image."},
+        {"role": "system", "content": STORYBOARD_SYSTEM_PROMPT},
         {"role": "user", "content": f"{trigger}'{text}'"},
     ] 
 
     return request_with_retry(messages)
 
-def read_docx(file_path):
-    return [paragraph.text for paragraph in Document(file_path).paragraphs if paragraph.text.strip()]
+def storyboard_sentence(text, trigger):
+    translated_text = translate_to_english(text)
+    return translated_text, translate_to_storyboard(translated_text, trigger)
 
-def process_text_sentences(workbook, input_file_path, output_file_path, trigger, keyword_dict, min_sentence_length):
+def parse_batch_reply(reply, count):
+    # 模型偶尔会包一层 ```json 代码块或在前后加说明文字，只取最外层的 JSON 数组
+    start, end = reply.find('['), reply.rfind(']')
+    if start == -1 or end <= start:
+        return {}
     try:
-        paragraphs = read_docx(input_file_path)
-    except ValueError as e:
-        print(f"发生错误：{str(e)}")
-        return
+        items = json.loads(reply[start:end + 1])
+    except ValueError:
+        return {}
+    if not isinstance(items, list):
+        return {}
 
+    results = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        try:
+            item_id = int(item.get('id'))
+        except (TypeError, ValueError):
+            continue
+        translation = item.get('translation')
+        prompt = item.get('prompt')
+        if 1 <= item_id <= count and isinstance(translation, str) and isinstance(prompt, str) and translation.strip() and prompt.strip():
+            results[item_id] = (translation.strip(), prompt.strip())
+    return results
+
+def storyboard_batch(texts, trigger):
+    # 一次请求处理多条句子：引导词只发送一次，翻译和分镜提示词一起以 JSON 返回；
+    # 解析失败或缺失的条目再单独走逐句翻译 + 分镜的流程
+    payload = json.dumps([{"id": i, "text": text} for i, text in enumerate(texts, 1)], ensure_ascii=False)
+    messages = [
+        {"role": "system", "content": STORYBOARD_SYSTEM_PROMPT},
+        {"role": "user", "content": (
+            "You will receive a JSON array of items, each with an \"id\" and a \"text\". For every item:\n"
+            f"1. Translate the text into English. {TRANSLATION_RULES}\n"
+            "2. Use that English translation as the theme and write a Stable Diffusion prompt for it, following these instructions: "
+            f"{trigger}\n"
+            "Reply with only a JSON array containing one object per input item, in the same order, shaped like "
+            "{\"id\": <the item's id>, \"translation\": \"<English translation>\", \"prompt\": \"<Stable Diffusion prompt>\"}. "
+            "Do not wrap the JSON in markdown and do not add any other text.\n"
+            f"Items: {payload}"
+        )},
+    ]
+    reply = request_with_retry(messages, max_tokens=BATCH_TOKENS_PER_ITEM * len(texts))
+    parsed = parse_batch_reply(reply, len(texts))
+
+    results = []
+    for i, text in enumerate(texts, 1):
+        results.append(parsed[i] if i in parsed else storyboard_sentence(text, trigger))
+    return results
+
+def get_nlp(segmenter='parser'):
+    global nlp
+    if nlp is None:
+        if segmenter == 'sentencizer':
+            # 纯规则分句：按标点切分，不需要下载和加载任何模型
+            nlp = spacy.blank('zh')
+            nlp.add_pipe('sentencizer')
+        else:
+            # 句子边界只由 parser（及其依赖的 tok2vec）给出，其余组件都不加载
+            nlp = spacy.load('zh_core_web_sm', exclude=['tagger', 'attribute_ruler', 'ner'])
+    return nlp
+
+def split_sentences(paragraphs, segmenter='parser', n_process=1, batch_size=64):
     sentences = []
-    for paragraph in paragraphs:
-        sentences.extend([sent.text for sent in nlp(paragraph).sents])
+    for doc in get_nlp(segmenter).pipe(paragraphs, batch_size=batch_size, n_process=n_process):
+        sentences.extend(sent.text for sent in doc.sents)
+    return sentences
 
-    sentences = merge_short_sentences(sentences, min_sentence_length)
+def read_docx(file_path):
+    return [paragraph.text for paragraph in Document(file_path).paragraphs if paragraph.text.strip()]
+
+def run_text(run):
+    parts = []
+    for child in run:
+        if child.tag == WORD_NAMESPACE + 't':
+            parts.append(child.text or '')
+        elif child.tag == WORD_NAMESPACE + 'tab':
+            parts.append('\t')
+        elif child.tag in (WORD_NAMESPACE + 'br', WORD_NAMESPACE + 'cr'):
+            parts.append('\n')
+    return ''.join(parts)
+
+def paragraph_text(paragraph):
+    parts = []
+    for child in paragraph:
+        if child.tag == WORD_NAMESPACE + 'r':
+            parts.append(run_text(child))
+        elif child.tag == WORD_NAMESPACE + 'hyperlink':
+            parts.extend(run_text(run) for run in child.findall(WORD_NAMESPACE + 'r'))
+    return ''.join(parts)
+
+def iter_docx_paragraphs(file_path):
+    # 直接流式解析 docx 里的 word/document.xml，逐段产出 (文本, 样式)，处理完的段落立即释放；
+    # 与 read_docx 一致，只取正文里的段落，跳过表格和文本框中的内容
+    with zipfile.ZipFile(file_path) as docx, docx.open('word/document.xml') as document:
+        table_depth = 0
+        paragraph_depth = 0
+        for event, elem in ET.iterparse(document, events=('start', 'end')):
+            if elem.tag == WORD_NAMESPACE + 'tbl':
+                table_depth += 1 if event == 'start' else -1
+                if event == 'end':
+                    elem.clear()
+            elif elem.tag == WORD_NAMESPACE + 'p':
+                if event == 'start':
+                    paragraph_depth += 1
+                    continue
+                paragraph_depth -= 1
+                if table_depth == 0 and paragraph_depth == 0:
+                    text = paragraph_text(elem)
+                    if text.strip():
+                        style = elem.find(f'{WORD_NAMESPACE}pPr/{WORD_NAMESPACE}pStyle')
+                        yield text, style.get(WORD_NAMESPACE + 'val', '') if style is not None else ''
+                    elem.clear()
+
+def is_chapter_heading(text, style, pattern):
+    return bool(pattern.match(text)) or style.lower().startswith(('heading', 'title'))
+
+def iter_chapters(paragraphs, chapter_pattern=None):
+    # 遇到章节标题就把之前累积的段落作为一个章节产出，内存里同时只保留一个章节；
+    # 标题段落本身保留在所属章节的开头，第一个标题之前的内容作为一个无标题章节
+    pattern = re.compile(chapter_pattern or CHAPTER_PATTERN)
+    title, chapter = '', []
+    for text, style in paragraphs:
+        if is_chapter_heading(text, style, pattern) and chapter:
+            yield title, chapter
+            chapter = []
+        if is_chapter_heading(text, style, pattern):
+            title = text.strip()
+        chapter.append(text)
+    if chapter:
+        yield title, chapter
+
+def normalize_sentence(sentence):
+    return ' '.join(sentence.split())
+
+def generate_storyboards(texts, trigger, concurrency=1, batch_size=1, known=None):
+    # 规范化后相同的句子只翻译、生成分镜一次，结果回填到每一行；
+    # known 保存已处理过的句子，流式模式下跨章节共用
+    known = {} if known is None else known
+    unique_texts = []
+    for text in texts:
+        key = normalize_sentence(text)
+        if key not in known:
+            known[key] = None
+            unique_texts.append(key)
+
+    for key, result in zip(unique_texts, request_storyboards(unique_texts, trigger, concurrency, batch_size)):
+        known[key] = result
+    return [known[normalize_sentence(text)] for text in texts]
 
-    original_sentences_dict = {}
-    sheet = workbook.active
-    for idx, sentence in enumerate(sentences, 1):
-        replaced_sentence, original_sentence = replace_keywords(sentence, keyword_dict)
-        original_sentences_dict[replaced_sentence] = original_sentence
-        sheet.cell(row=idx, column=1, value=replaced_sentence)
-        sheet.cell(row=idx, column=4, value=original_sentence)
+def print_dedup_report(total_rows, unique_rows):
+    duplicated = total_rows - unique_rows
+    ratio = duplicated / total_rows * 100 if total_rows else 0
+    print(f"共 {total_rows} 句，去重后实际处理 {unique_rows} 句，重复句子 {duplicated} 句，占 {ratio:.1f}%")
 
-    replaced_sentences = list(original_sentences_dict.keys())
+def request_storyboards(texts, trigger, concurrency=1, batch_size=1):
+    results = [None] * len(texts)
+    if not texts:
+        return results
+    max_workers = max(1, min(len(texts), concurrency))
 
-    max_workers = min(len(replaced_sentences), 1)
+    if batch_size > 1:
+        numbered = list(enumerate(texts))
+        batches = [numbered[i:i + batch_size] for i in range(0, len(numbered), batch_size)]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(storyboard_batch, [text for _, text in batch], trigger): batch for batch in batches}
+            progress_bar = tqdm(total=len(texts), desc='正在批量翻译并生成分镜脚本')
+            for future in as_completed(futures):
+                batch = futures[future]
+                for (idx, _), result in zip(batch, future.result()):
+                    results[idx] = result
+                progress_bar.update(len(batch))
+            progress_bar.close()
+        return results
 
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures_translation = {executor.submit(translate_to_english, sentence.strip()): idx for idx, sentence in enumerate(replaced_sentences, 1)}
+        futures_translation = {executor.submit(translate_to_english, text): idx for idx, text in enumerate(texts)}
         futures_storyboard = {}
 
         for future in tqdm(as_completed(futures_translation), total=len(futures_translation), desc='正在翻译文本'):
             idx = futures_translation[future]
             translated_text = future.result()
-            sheet.cell(row=idx, column=2, value=translated_text)
+            results[idx] = (translated_text, None)
             futures_storyboard[executor.submit(translate_to_storyboard, translated_text, trigger)] = idx
 
         for future in tqdm(as_completed(futures_storyboard), total=len(futures_storyboard), desc='正在生成分镜脚本'):
             idx = futures_storyboard[future]
-            storyboard_text = future.result()
-            sheet.cell(row=idx, column=3, value=storyboard_text)
+            results[idx] = (results[idx][0], future.result())
 
-    workbook.save(output_file_path)
+    return results
 
+def process_text_sentences(manifest, input_file_path, export_path, trigger, keyword_dict, min_sentence_length, concurrency=1, batch_size=1, segmenter='parser', segment_processes=1, on_rows=None):
+    try:
+        paragraphs = read_docx(input_file_path)
+    except ValueError as e:
+        print(f"发生错误：{str(e)}")
+        return
 
-def main():
-    config = load_config()
-    print("软件作者：西装革律")
-    print("禁止倒卖，违者必究！")
-    print("交流群：797579852")  
-    role_name = config.get('角色名', '未指定角色名')
-    feature = config.get('特征', '未指定特征')
-    role2_name = config.get('角色名2', '未指定角色名2')
-    feature2 = config.get('特征2', '未指定特征2')
-    role3_name = config.get('角色名3', '未指定角色名3')
-    feature3 = config.get('特征3', '未指定特征3')
-    role4_name = config.get('角色名4', '未指定角色名4')
-    feature4 = config.get('特征4', '未指定特征4')
-    role5_name = config.get('角色名5', '未指定角色名5')
-    feature5 = config.get('特征5', '未指定特征5')
-    role6_name = config.get('角色名6', '未指定角色名6')
-    feature6 = config.get('特征6', '未指定特征6')
-    role7_name = config.get('角色名7', '未指定角色名7')
-    feature7 = config.get('特征7', '未指定特征7')
-    role8_name = config.get('角色名8', '未指定角色名8')
-    feature8 = config.get('特征8', '未指定特征8')
-    role9_name = config.get('角色名9', '未指定角色名9')
-    feature9 = config.get('特征9', '未指定特征9')
-    role10_name = config.get('角色名10', '未指定角色名10')
-    feature10 = config.get('特征10', '未指定特征10')
-    keyword_dict = {
-    role_name: feature,
-    role2_name: feature2,
-    role3_name: feature3,
-    role4_name: feature4,
-    role5_name: feature5,
-    role6_name: feature6,
-    role7_name: feature7,
-    role8_name: feature8,
-    role9_name: feature9,
-    role10_name: feature10,   
-    }
+    sentences = split_sentences(paragraphs, segmenter, segment_processes)
+
+    sentences = merge_short_sentences(sentences, min_sentence_length)
+
+    replacer = KeywordReplacer(keyword_dict)
+    rows = [replace_keywords(sentence, replacer) for sentence in sentences]
+
+    known = {}
+    storyboards = generate_storyboards([replaced_sentence for replaced_sentence, _ in rows], trigger, concurrency, batch_size, known)
+    print_dedup_report(len(rows), len(known))
+
+    manifest.reset()
+    first_row = manifest.append_rows([{'sentence': replaced_sentence, 'translation': translated_text, 'prompt': storyboard_text, 'original': original_sentence}
+                                      for (replaced_sentence, original_sentence), (translated_text, storyboard_text) in zip(rows, storyboards)])
+    if on_rows is not None:
+        on_rows(first_row, len(rows))
+    if export_path:
+        manifest.export_xlsx(export_path)
+
+def write_chapter_index(chapter_dir, chapters):
+    with open(os.path.join(chapter_dir, 'index.json'), 'w', encoding='utf-8') as f:
+        json.dump(chapters, f, ensure_ascii=False, indent=2)
+
+def process_text_chapters(manifest, input_file_path, export_path, trigger, keyword_dict, min_sentence_length, concurrency=1, batch_size=1, segmenter='parser', segment_processes=1, chapter_pattern=None, on_rows=None):
+    # 流式模式：逐段读取文档、按章节分片，每处理完一章就把该章追加进清单、写出分片 txt/chapters/chapter_NNNN.xlsx
+    # 并更新 txt/chapters/index.json（记录每章在清单中的起始行），后续步骤可以按章节提前开始，不在内存中保留整本书
+    chapter_dir = os.path.join(os.path.dirname(manifest.path), 'chapters')
+    os.makedirs(chapter_dir, exist_ok=True)
+    for stale_file in glob.glob(os.path.join(chapter_dir, 'chapter_*.xlsx')):
+        os.remove(stale_file)
+
+    replacer = KeywordReplacer(keyword_dict)
+    manifest.reset()
+    chapters = []
+    total_rows = 0
+    known = {}
+
+    try:
+        for title, paragraphs in iter_chapters(iter_docx_paragraphs(input_file_path), chapter_pattern):
+            sentences = merge_short_sentences(split_sentences(paragraphs, segmenter, segment_processes), min_sentence_length)
+            if not sentences:
+                continue
+
+            chapter_number = len(chapters) + 1
+            print(f"正在处理第 {chapter_number} 章：{title or '（无标题）'}，共 {len(sentences)} 句")
+            rows = [replace_keywords(sentence, replacer) for sentence in sentences]
+            storyboards = generate_storyboards([replaced_sentence for replaced_sentence, _ in rows], trigger, concurrency, batch_size, known)
+
+            shard_name = f'chapter_{chapter_number:04d}.xlsx'
+            shard = openpyxl.Workbook(write_only=True)
+            shard_sheet = shard.create_sheet()
+            for (replaced_sentence, original_sentence), (translated_text, storyboard_text) in zip(rows, storyboards):
+                shard_sheet.append([replaced_sentence, translated_text, storyboard_text, original_sentence])
+            shard.save(os.path.join(chapter_dir, shard_name))
+            first_row = manifest.append_rows([{'sentence': replaced_sentence, 'translation': translated_text, 'prompt': storyboard_text, 'original': original_sentence, 'chapter': chapter_number}
+                                              for (replaced_sentence, original_sentence), (translated_text, storyboard_text) in zip(rows, storyboards)])
+
+            chapters.append({'chapter': chapter_number, 'title': title, 'file': shard_name, 'first_row': first_row, 'rows': len(rows)})
+            total_rows += len(rows)
+            write_chapter_index(chapter_dir, chapters)
+            if on_rows is not None:
+                on_rows(first_row, len(rows))
+    except (zipfile.BadZipFile, KeyError, ET.ParseError) as e:
+        print(f"发生错误：{str(e)}")
+        return
+
+    if export_path:
+        manifest.export_xlsx(export_path)
+    print_dedup_report(total_rows, len(known))
+
+
+def extract_text(config, manifest, on_rows=None):
+    # 完成一章（非流式模式下是全部文本）写入清单后调用 on_rows(首行序号, 行数)，供流水线提前开始后续步骤
+    global rate_limiter, llm_cache
+    keyword_dict = load_keyword_dict(config)
 
     min_sentence_length = int(config.get('句子最小长度限制', 100))
     default_trigger = '''Here, I introduce the concept of Prompts from the StableDiffusion algorithm, also known as hints. 
@@ -185,12 +477,46 @@ def main():
     Here is the content:'''
     trigger = config.get('引导词', default_trigger)
 
+    rate_limiter = RateLimiter(config.get('llm_rpm', 60), config.get('llm_tpm', 60000))
+    concurrency = int(config.get('llm_concurrency', 4))
+    batch_size = int(config.get('llm_batch_size', 1))
+    segmenter = config.get('segmenter', 'parser')
+    segment_processes = int(config.get('segment_processes', 1))
+    stream_chapters = config.get('stream_chapters', False)
+    chapter_pattern = config.get('chapter_pattern') or None
+    export_xlsx = config.get('export_xlsx', True)
+
     current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     input_file_path = os.path.join(current_dir, 'input.docx')
-    output_file_path = os.path.join(current_dir, 'txt', 'txt.xlsx')
-    workbook = openpyxl.Workbook()
+    export_path = os.path.join(current_dir, 'txt', 'txt.xlsx') if export_xlsx else None
+
+    if config.get('llm_cache', True):
+        os.makedirs(os.path.join(current_dir, 'temp'), exist_ok=True)
+        llm_cache = LLMCache(os.path.join(current_dir, 'temp', 'llm_cache.sqlite'), int(config.get('llm_cache_max_mb', 200)) * 1024 * 1024)
+
+    if stream_chapters:
+        process_text_chapters(manifest, input_file_path, export_path, trigger, keyword_dict, min_sentence_length, concurrency, batch_size, segmenter, segment_processes, chapter_pattern, on_rows)
+    else:
+        process_text_sentences(manifest, input_file_path, export_path, trigger, keyword_dict, min_sentence_length, concurrency, batch_size, segmenter, segment_processes, on_rows=on_rows)
+
+    if llm_cache is not None:
+        print(llm_cache.summary())
+        llm_cache.close()
+        llm_cache = None
+
+
+def main():
+    config = load_config()
+    print("软件作者：西装革律")
+    print("禁止倒卖，违者必究！")
+    print("交流群：797579852")  
 
-    process_text_sentences(workbook, input_file_path, output_file_path, trigger, keyword_dict, min_sentence_length)
+    metrics.start_run()
+    manifest = Manifest(MANIFEST_PATH)
+    extract_text(config, manifest)
+    print(f"文本清单共 {len(manifest)} 行：{MANIFEST_PATH}")
+    manifest.close()
+    metrics.finish_run()
 
 if __name__ == "__main__":
     main()
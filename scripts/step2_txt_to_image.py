@@ -0,0 +1,461 @@
+import os
+import copy
+import json
+import time
+import shutil
+import argparse
+import asyncio
+import itertools
+import collections
+import threading
+import chardet
+from PIL import Image
+from tqdm import tqdm
+from manifest import open_manifest, relative_path
+from sd_client import SDClient, SDError, parse_addresses
+from generation_ledger import GenerationLedger, params_hash, parse_info, request_key
+import metrics
+
+current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+image_extensions = ['.png', '.webp', '.jpg', '.jpeg']
+ledger_path = os.path.join(current_dir, 'temp', 'generation_ledger.sqlite')
+
+# 绘图质量档位：都用 ADetailer 修复面部和手部；low 另外启用 Tiled Diffusion 和 Tiled VAE 分块绘制，显存不足时使用
+PROFILES = {
+    'high': {
+        "ADetailer": {
+            "args": [
+                {"ad_model": "face_yolov8n.pt"},
+                {"ad_model": "hand_yolov8n.pt"}
+            ]
+        }
+    },
+    'low': {
+        "ADetailer": {
+            "args": [
+                {"ad_model": "face_yolov8n.pt"},
+                {"ad_model": "hand_yolov8n.pt"}
+            ]
+        },
+        "Tiled Diffusion": {
+            "args": [
+                {
+                    "method": "Mixture of Diffusers",
+                    "tile_width": 96,
+                    "tile_height": 96,
+                    "overlap": 48,
+                    "tile_batch_size": 4,
+                }
+            ]
+        },
+        "Tiled VAE": {
+            "args": [
+                {
+                    "enabled": True,
+                    "encoder_tile_size": 960,
+                    "decoder_tile_size": 80,
+                    "vae_to_gpu": True,
+                    "fast_decoder": True,
+                    "fast_encoder": True,
+                    "color_fix": False
+                }
+            ]
+        }
+    },
+}
+# 只在成图上做的收尾处理，不影响构图，画草图时跳过
+FINISHING_SCRIPTS = ['ADetailer']
+
+def load_config():
+    config_file = os.path.join(current_dir, 'config.json')
+    if not os.path.exists(config_file):
+        return {}
+
+    with open(config_file, 'rb') as f:
+        raw_data = f.read()
+        detected_encoding = chardet.detect(raw_data)['encoding']
+    with open(config_file, 'r', encoding=detected_encoding) as f:
+        return json.load(f)
+
+def index_images(image_dir):
+    # 只列一次目录，建立 编号 → 图片路径 的索引；同一编号有多种格式时按 image_extensions 的顺序取
+    images = {}
+    for name in os.listdir(image_dir):
+        stem, ext = os.path.splitext(name)
+        if ext.lower() in image_extensions and stem.startswith('output_') and stem[len('output_'):].isdigit():
+            number = int(stem[len('output_'):])
+            current = images.get(number)
+            if current is None or image_extensions.index(ext.lower()) < image_extensions.index(os.path.splitext(current)[1].lower()):
+                images[number] = os.path.join(image_dir, name)
+    return images
+
+def get_prompts(manifest):
+    # 第 i 个提示词对应清单第 i+1 行，空行保留为空字符串，保证与 output_N 的编号一致
+    return [row['prompt'] or '' for row in manifest.rows()]
+    
+def get_cloud_address():
+    config = load_config()
+    cloud_address = config.get('cloud_address')
+    more_details = config.get('more_details')
+    data = config.get('data')
+
+    if not cloud_address:
+        cloud_address = None
+    if more_details is None:
+        more_details = {}
+    if data is None:
+        data = {}
+
+    return cloud_address, more_details, data
+
+def get_sd_options():
+    config = load_config()
+    return int(config.get('sd_max_in_flight', 1)), int(config.get('sd_timeout', 600))
+
+def get_draw_options():
+    config = load_config()
+    return {
+        'image_format': config.get('image_format', 'png'),
+        'reuse_images': config.get('reuse_images', True),
+        'redraw_seed': config.get('redraw_seed', 'vary'),
+        'profile': config.get('image_profile', 'high'),
+        'draft_first': config.get('draft_first', True),
+    }
+
+def build_payload(data=None, profile='high'):
+    fixed_data = {"alwayson_scripts": copy.deepcopy(PROFILES[profile])}
+
+    if data:
+        fixed_data.update(data)
+    # 新版 WebUI 不再读取 firstphase_width/height，放大前的尺寸改用 width/height，草图才能画成同样大小
+    for key in ('width', 'height'):
+        if 'firstphase_' + key in fixed_data and key not in fixed_data:
+            fixed_data[key] = fixed_data.pop('firstphase_' + key)
+    return fixed_data
+
+def draft_payload(fixed_data):
+    # 草图与成图的尺寸、采样器、步数相同，只是不做高分辨率放大和收尾处理；按同一种子放大时第一遍画出的就是这张草图
+    payload = dict(fixed_data, enable_hr=False, restore_faces=False)
+    payload['alwayson_scripts'] = {name: args for name, args in fixed_data.get('alwayson_scripts', {}).items() if name not in FINISHING_SCRIPTS}
+    return payload
+
+def store_image(png_path, image_format='png'):
+    # WebUI 返回的是 PNG：webp=转存为无损 WebP，png_optimized=无损重新压缩 PNG，png=原样保存
+    stem = os.path.splitext(png_path)[0]
+    output_path = png_path
+    if image_format == 'webp':
+        output_path = stem + '.webp'
+        with Image.open(png_path) as im:
+            im.save(output_path, 'WEBP', lossless=True, method=4)
+        os.remove(png_path)
+    elif image_format == 'png_optimized':
+        with Image.open(png_path) as im:
+            im.save(png_path + '.tmp', 'PNG', optimize=True)
+        os.replace(png_path + '.tmp', png_path)
+
+    remove_stale_images(output_path)
+    return output_path
+
+def remove_stale_images(output_path):
+    # 同一编号换了格式时删掉旧文件，避免后续步骤读到旧图
+    stem = os.path.splitext(output_path)[0]
+    for ext in image_extensions:
+        if stem + ext != output_path and os.path.exists(stem + ext):
+            os.remove(stem + ext)
+
+def save_result(result, fixed_data, output_path, image_format='png', ledger=None):
+    # 图片已经由绘图池边下载边写入 output_path，这里按需转存格式并记入台账，返回最终的文件路径
+    output_path = store_image(output_path, image_format)
+    if ledger is not None:
+        ledger.record(fixed_data, output_path, *parse_info(result))
+    return output_path
+
+def reuse_image(source, fixed_data, output_path, ledger):
+    # 复制台账里同提示词同参数的已有图片，保留原图的格式
+    output_path = os.path.splitext(output_path)[0] + os.path.splitext(source['output_path'])[1]
+    if os.path.abspath(source['output_path']) != os.path.abspath(output_path):
+        shutil.copyfile(source['output_path'], output_path)
+    remove_stale_images(output_path)
+    ledger.record(fixed_data, output_path, source['seed'], source['info'], reused_from=source['id'])
+    return output_path
+
+async def produce_image(client, ledger, fixed_data, output_path, options, reuse=True):
+    loop = asyncio.get_running_loop()
+    if not (reuse and options['reuse_images']):
+        result = await client.txt2img(fixed_data, output_path)
+        # 格式转换比较耗 CPU，放到线程里做，不耽误其他图片的下载
+        return await loop.run_in_executor(None, save_result, result, fixed_data, output_path, options['image_format'], ledger)
+
+    # 同样的请求正在画时等它画完再复用，不重复提交
+    key = request_key(fixed_data)
+    while key in ledger.pending:
+        await asyncio.shield(ledger.pending[key])
+    source = ledger.find_reusable(fixed_data)
+    if source is not None:
+        ledger.reused += 1
+        return await loop.run_in_executor(None, reuse_image, source, fixed_data, output_path, ledger)
+
+    ledger.pending[key] = loop.create_future()
+    try:
+        result = await client.txt2img(fixed_data, output_path)
+        return await loop.run_in_executor(None, save_result, result, fixed_data, output_path, options['image_format'], ledger)
+    finally:
+        ledger.pending.pop(key).set_result(None)
+
+# 常驻的绘图会话：提示词和图片索引只在开始时读取一次并保存在内存里，绘图任务放进优先队列，
+# 重绘任务排在首轮绘图之前；用户随时可以输入重绘编号，不必等首轮全部画完。
+# draft_first 时分两轮：先给每一行画不放大的草图并记下种子，用户输入 N 确认后，
+# 只把留下来的草图按原种子用完整参数重画（高分辨率放大 + 收尾处理），被重绘掉的图不再花放大的时间。
+class DrawSession:
+    REDRAW = 0
+    FIRST_PASS = 1
+    UPSCALE = 2
+    STOP = 3
+    PHASES = {REDRAW: 'redraw', FIRST_PASS: 'first_pass', UPSCALE: 'upscale'}
+
+    def __init__(self, client, manifest, ledger, fixed_data, image_dir, options, more_details):
+        self.client = client
+        self.manifest = manifest
+        self.ledger = ledger
+        self.fixed_data = fixed_data
+        self.more_details = more_details
+        self.image_dir = image_dir
+        self.options = options
+        self.draft_data = draft_payload(fixed_data) if options['draft_first'] else fixed_data
+        self.draft_hash = params_hash(self.draft_data)[0]
+        self.approved = False
+        self.prompts = get_prompts(manifest)
+        self.images = index_images(image_dir)
+        self.workers = client.capacity
+        self.queue = asyncio.PriorityQueue()
+        self.sequence = itertools.count()
+        self.pending_redraws = set()
+        # 同一位置的任务（首轮、重绘、放大）不能同时进行，否则会写同一个临时文件
+        self.slot_locks = collections.defaultdict(asyncio.Lock)
+        self.first_pass_rows = set()
+        self.progress = tqdm(total=0, desc='绘图进度', unit='image')
+
+    def submit(self, i, priority):
+        self.queue.put_nowait((priority, next(self.sequence), i, time.time()))
+        self.progress.total += 1
+        self.progress.refresh()
+
+    def submit_first_pass(self):
+        for i, prompt in enumerate(self.prompts):
+            if prompt and i + 1 not in self.images:
+                self.submit(i, self.FIRST_PASS)
+                self.first_pass_rows.add(i + 1)
+        if not self.first_pass_rows:
+            self.first_pass_done()
+
+    def first_pass_done(self):
+        if self.options['draft_first']:
+            self.progress.write("Stable Diffusion草图绘制完成，请检查图片，不想踩缝纫机就赶紧把小黄图删了~ 确认无误后输入N开始高清放大")
+        else:
+            self.progress.write("Stable Diffusion绘图完成，请检查图片，不想踩缝纫机就赶紧把小黄图删了~")
+
+    def row_prompt(self, file_number):
+        # 上次中断时留下的草图可能超出本次文本的行数，或者对应的行已经没有提示词
+        if not 1 <= file_number <= len(self.prompts) or not self.prompts[file_number - 1]:
+            return None
+        return f"{self.prompts[file_number - 1]},{self.more_details}"
+
+    def is_draft(self, file_number):
+        # 台账里这个位置最新的图是按草图参数画的，就还没有放大
+        if not self.options['draft_first']:
+            return False
+        current = self.ledger.current(os.path.join(self.image_dir, f'output_{file_number}.png'))
+        return current is not None and current['params_hash'] == self.draft_hash
+
+    def request_redraw(self, user_input):
+        if user_input.strip() == "N":
+            self.close()
+            return
+
+        for s in user_input.split():
+            try:
+                file_number = int(s.strip())
+            except ValueError:
+                self.progress.write(f"无效输入: {s.strip()}，跳过")
+                continue
+            if not 1 <= file_number <= len(self.prompts) or not self.prompts[file_number - 1]:
+                self.progress.write(f"无效图片: output_{file_number}")
+                continue
+            if file_number in self.first_pass_rows:
+                self.progress.write(f"output_{file_number} 还没有画完，画完后再输入重绘")
+                continue
+            if file_number in self.pending_redraws:
+                continue
+
+            self.pending_redraws.add(file_number)
+            self.submit(file_number - 1, self.REDRAW)
+            self.progress.write(f"重绘图片: output_{file_number}")
+
+    def close(self):
+        # 用户确认后把现有的草图都排进放大队列，之后画完的草图在 draw 里自行排队
+        self.approved = True
+        for file_number in sorted(self.images):
+            if self.row_prompt(file_number) is not None and self.is_draft(file_number):
+                self.submit(file_number - 1, self.UPSCALE)
+        # 停止标记的优先级最低，已经排队的首轮、重绘和放大任务都画完后各个工作协程才退出
+        for _ in range(self.workers):
+            self.queue.put_nowait((self.STOP, next(self.sequence), None, None))
+
+    async def worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            priority, _, i, submitted = await self.queue.get()
+            if priority == self.STOP:
+                return
+
+            file_number = i + 1
+            # 绘图请求的性能数据里带上行号、轮次和在会话队列里等待的时间
+            metrics.bind(row=file_number, phase=self.PHASES[priority], waited=round(time.time() - submitted, 3))
+            async with self.slot_locks[file_number]:
+                if priority == self.REDRAW:
+                    self.pending_redraws.discard(file_number)
+                    self.discard_image(file_number)
+                if priority == self.UPSCALE:
+                    await self.upscale(file_number)
+                else:
+                    await self.draw(loop, file_number, priority)
+            self.progress.update(1)
+
+            if priority == self.FIRST_PASS:
+                self.first_pass_rows.discard(file_number)
+                if not self.first_pass_rows:
+                    self.first_pass_done()
+
+    def discard_image(self, file_number):
+        # 被要求重绘的图在台账里标记为不合格，之后不会再被复用
+        self.ledger.reject(os.path.join(self.image_dir, f'output_{file_number}.png'))
+        file_path = self.images.pop(file_number, None)
+        if file_path and os.path.exists(file_path):
+            try:
+                os.remove(file_path)
+            except OSError as e:
+                self.progress.write(f'错误：无法删除 output_{file_number}，重绘后会直接覆盖 {str(e)}')
+
+    async def draw(self, loop, file_number, priority):
+        output_path = os.path.join(self.image_dir, f'output_{file_number}.png')
+        payload = dict(self.draft_data, prompt=self.row_prompt(file_number))
+        if priority == self.REDRAW:
+            payload['seed'] = self.ledger.redraw_seed(payload, output_path, self.options['redraw_seed'])
+        try:
+            output_path = await produce_image(self.client, self.ledger, payload, output_path, self.options, reuse=priority == self.FIRST_PASS)
+        # 单张图保存或转换失败（文件被占用、图片数据损坏等）只跳过这一张，不结束整个会话
+        except (SDError, OSError, ValueError) as e:
+            self.progress.write(f'错误：output_{file_number} {str(e)}')
+            return
+
+        self.images[file_number] = output_path
+        self.manifest.update(file_number, image_path=relative_path(output_path))
+        if priority == self.REDRAW:
+            self.progress.write(f"output_{file_number} 重绘完成，请检查图片，你确定还不删小黄图么？")
+        if self.approved and self.is_draft(file_number):
+            self.submit(file_number - 1, self.UPSCALE)
+
+    async def upscale(self, file_number):
+        output_path = os.path.join(self.image_dir, f'output_{file_number}.png')
+        if not self.is_draft(file_number):
+            return
+        current = self.ledger.current(output_path)
+        prompt = self.row_prompt(file_number)
+        if current['seed'] is None:
+            self.progress.write(f"output_{file_number} 没有记录到种子，保留草图")
+            return
+        # 文本改过之后行号可能错位，只有草图的提示词和这一行现在的提示词相同时才按原种子放大
+        if prompt is None or current['prompt'] != prompt:
+            self.progress.write(f"output_{file_number} 的提示词与草图不一致（文本改过？），保留草图，需要时输入编号重绘")
+            return
+
+        payload = dict(self.fixed_data, prompt=prompt, seed=current['seed'])
+        try:
+            output_path = await produce_image(self.client, self.ledger, payload, output_path, self.options)
+        except (SDError, OSError, ValueError) as e:
+            self.progress.write(f'错误：output_{file_number} 放大失败，保留草图 {str(e)}')
+            return
+
+        self.images[file_number] = output_path
+        self.manifest.update(file_number, image_path=relative_path(output_path))
+
+def read_redraw_requests(loop, session):
+    # 在单独的线程里等待输入，不阻塞绘图
+    while True:
+        try:
+            user_input = input()
+        except EOFError:
+            user_input = "N"
+        loop.call_soon_threadsafe(session.request_redraw, user_input)
+        if user_input.strip() == "N":
+            return
+
+async def draw_session(addresses, manifest, ledger, fixed_data, image_dir, options, more_details, max_in_flight=1, timeout=600):
+    async with SDClient(addresses, max_in_flight, timeout) as client:
+        session = DrawSession(client, manifest, ledger, fixed_data, image_dir, options, more_details)
+        session.submit_first_pass()
+        if options['draft_first']:
+            print("绘图期间随时可以输入需要重绘的草图对应的数字（多个数字用空格隔开），重绘会优先进行；输入N确认全部草图，按原种子高清放大后退出程序")
+        else:
+            print("绘图期间随时可以输入需要重绘的图片对应的数字（多个数字用空格隔开），重绘会优先进行；输入N等待剩余图片画完后退出程序")
+        threading.Thread(target=read_redraw_requests, args=(asyncio.get_running_loop(), session), daemon=True).start()
+
+        await asyncio.gather(*(session.worker() for _ in range(session.workers)))
+        session.progress.close()
+        if ledger.reused:
+            print(f"复用台账中提示词和参数都相同的已有图片 {ledger.reused} 张")
+        if len(addresses) > 1:
+            print(client.summary())
+
+def run_program(cloud_address, data=None, more_details=None, max_in_flight=1, timeout=600, options=None):
+    options = options or get_draw_options()
+    # 与流水线一样，提示词后缀作为参数传进绘图会话；没有传入时从配置文件读取
+    if more_details is None:
+        more_details = get_cloud_address()[1]
+    fixed_data = build_payload(data, options['profile'])
+    addresses = parse_addresses(cloud_address)
+
+    if not addresses:
+        print("未提供云端Stable Diffusion地址")
+        return
+
+    image_dir = os.path.join(current_dir, 'image')
+    os.makedirs(image_dir, exist_ok=True)
+
+    os.makedirs(os.path.dirname(ledger_path), exist_ok=True)
+    manifest = open_manifest()
+    ledger = GenerationLedger(ledger_path)
+    asyncio.run(draw_session(addresses, manifest, ledger, fixed_data, image_dir, options, more_details, max_in_flight, timeout))
+    ledger.close()
+    manifest.close()
+
+if __name__ == '__main__':
+    print("软件作者：西装革律")
+    print("禁止倒卖，违者必究！")
+    print("交流群：797579852")
+
+    parser = argparse.ArgumentParser(description='Stable Diffusion绘图')
+    parser.add_argument('--profile', type=str, choices=sorted(PROFILES), help='绘图质量档位，不填时使用配置文件中的 image_profile；low=低显存')
+    parser.add_argument('--no_draft', action='store_true', help='不先画草图，每张图直接按完整参数绘制')
+    args = parser.parse_args()
+
+    cloud_address, more_details, data = get_cloud_address()
+    max_in_flight, timeout = get_sd_options()
+    options = get_draw_options()
+    if args.profile:
+        options['profile'] = args.profile
+    if args.no_draft:
+        options['draft_first'] = False
+
+    if cloud_address is None:
+        cloud_address = "http://127.0.0.1:7860"
+        print("使用本地Stable Diffusion")
+    elif len(parse_addresses(cloud_address)) > 1:
+        print(f"使用 {len(parse_addresses(cloud_address))} 台云端Stable Diffusion同时绘图")
+    else:
+        print("使用云端Stable Diffusion")
+
+    print("Stable Diffusion正在绘图，请稍后...")
+    metrics.start_run()
+    run_program(cloud_address, data=data, more_details=more_details, max_in_flight=max_in_flight, timeout=timeout, options=options)
+    metrics.finish_run()
@@ -1,5 +1,4 @@
 import os
-import openpyxl
 import asyncio
 from tqdm.asyncio import tqdm as async_tqdm
 import argparse
@@ -8,7 +7,13 @@ from azure.cognitiveservices.speech import SpeechConfig, SpeechSynthesizer, Audi
 from io import BytesIO
 import html
 import json
+import time
+import wave
 import chardet
+from concurrent.futures import ThreadPoolExecutor
+from manifest import open_manifest, relative_path, MANIFEST_PATH
+from rate_limiter import backoff_delay
+import metrics
 
 
 def load_config():
@@ -37,70 +42,262 @@ prosody_pitch = config.get('prosody_pitch')
 prosody_volume = config.get('prosody_volume')
 emphasis_level = config.get('emphasis_level')
 style_degree = config.get('style_degree')
+tts_concurrency = int(config.get('azure_tts_concurrency', 4))
+tts_max_attempts = int(config.get('azure_tts_max_attempts', 5))
+tts_batch_size = max(1, int(config.get('azure_tts_batch_size', 1)))
+tts_batch_chars = int(config.get('azure_tts_batch_chars', 1000))
 
+# 合成器池：固定数量的 SpeechSynthesizer 建好连接后反复使用，同时进行的合成数不超过池的大小，
+# 阻塞的 speak_ssml_async().get() 放在池专用的线程里执行。出错的合成器丢弃，下次取到空位时重新建立；
+# 每次合成最多尝试 max_attempts 次，两次之间按指数退避等待，避免被限流时所有请求一起反复重试。
+# synthesizer_factory 可以换成本地模拟的合成器（fake_azure_tts.FakeSynthesizer），没有密钥时也能测试。
 class SpeechProvider:
-    def __init__(self, config=None):
+    def __init__(self, config=None, concurrency=None, max_attempts=None, synthesizer_factory=None):
         self._config = config or {}
+        self.concurrency = max(1, concurrency or tts_concurrency)
+        self.max_attempts = max(1, max_attempts or tts_max_attempts)
+        self._synthesizer_factory = synthesizer_factory
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self._pool = None
 
-    async def get_tts_audio(self, message, language, index):
-        while True:
+    def _connect(self):
+        if self._synthesizer_factory is not None:
+            synthesizer, connection = self._synthesizer_factory(), None
+        else:
+            speech_config = SpeechConfig(subscription=subscription, region=region)
+            speech_config.speech_synthesis_voice_name = voice_name
+            synthesizer = SpeechSynthesizer(speech_config=speech_config, audio_config=None)
+            # 提前建立连接，第一句不用再等握手
+            connection = speechsdk.Connection.from_speech_synthesizer(synthesizer)
+            connection.open(True)
+        # 书签事件在 SDK 的回调线程里触发，记下书签名和它在音频中的偏移（单位 100 纳秒）
+        marks = []
+        synthesizer.bookmark_reached.connect(lambda evt: marks.append((evt.text, evt.audio_offset)))
+        return synthesizer, connection, marks
+
+    async def _acquire(self):
+        if self._pool is None:
+            # 池里先放空位，最先开始的几句各自并行建立连接
+            self._pool = asyncio.Queue()
+            for _ in range(self.concurrency):
+                self._pool.put_nowait(None)
+        item = await self._pool.get()
+        if item is None:
+            try:
+                item = await asyncio.get_running_loop().run_in_executor(self._executor, self._connect)
+            except Exception:
+                self._pool.put_nowait(None)
+                raise
+        return item
+
+    def _release(self, item, broken=False):
+        if broken:
+            if item[1] is not None:
+                item[1].close()
+            item = None
+        self._pool.put_nowait(item)
+
+    def build_ssml(self, content, language):
+        # content 是已经转义过的文本，可以夹带书签等 SSML 标签
+        return f"""
+        <speak version='1.0' xmlns='http://www.w3.org/2001/10/synthesis' xmlns:mstts='http://www.w3.org/2001/mstts' xml:lang='{language}'>
+          <voice name='{voice_name}'>
+            <mstts:express-as style='{style}' role='{role}' styledegree='{style_degree}'>
+              <prosody rate='{prosody_rate}' pitch='{prosody_pitch}' volume='{prosody_volume}'>
+                {content}
+              </prosody>
+            </mstts:express-as>
+          </voice>
+        </speak>
+        """
+
+    async def speak(self, ssml_text, label):
+        # 带重试地合成一段 SSML，返回 (结果, 书签列表, 尝试次数, 最后一次请求的耗时)，用完尝试次数时抛出 RuntimeError
+        loop = asyncio.get_running_loop()
+        error = None
+        for attempt in range(self.max_attempts):
+            if attempt:
+                delay = backoff_delay(attempt - 1, base=1, cap=30)
+                print(f"{label} 的语音合成出错，错误信息：{error}，{delay:.1f} 秒后进行第 {attempt + 1} 次尝试...")
+                await asyncio.sleep(delay)
+            try:
+                item = await self._acquire()
+            except Exception as e:
+                error = str(e)
+                continue
+
+            broken = True
             try:
-                speech_config = SpeechConfig(subscription=subscription, region=region)
-                speech_config.speech_synthesis_voice_name = voice_name
-                synthesizer = SpeechSynthesizer(speech_config=speech_config, audio_config=None)
-                escaped_message = html.escape(message)
-                ssml_text = f"""
-                <speak version='1.0' xmlns='http://www.w3.org/2001/10/synthesis' xmlns:mstts='http://www.w3.org/2001/mstts' xml:lang='{language}'>
-                  <voice name='{voice_name}'>
-                    <mstts:express-as style='{style}' role='{role}' styledegree='{style_degree}'>
-                      <prosody rate='{prosody_rate}' pitch='{prosody_pitch}' volume='{prosody_volume}'>
-                        {escaped_message}
-                      </prosody>
-                    </mstts:express-as>
-                  </voice>
-                </speak>
-                """
-                loop = asyncio.get_running_loop()
-                result = await loop.run_in_executor(None, lambda: synthesizer.speak_ssml_async(ssml_text).get())
+                synthesizer, _, marks = item
+                marks.clear()
+                request_start = time.perf_counter()
+                result = await loop.run_in_executor(self._executor, lambda: synthesizer.speak_ssml_async(ssml_text).get())
                 if result.reason == ResultReason.SynthesizingAudioCompleted:
-                    audio_data = BytesIO(result.audio_data)
-                    return {"index": index, "audio_data": audio_data, "error": None}
+                    broken = False
+                    return result, list(marks), attempt + 1, time.perf_counter() - request_start
                 elif result.reason == ResultReason.Canceled:
                     cancellation_details = speechsdk.SpeechSynthesisCancellationDetails(result)
-                    print(f"序号 {index} 的语音合成出错，错误信息：{str(cancellation_details.reason)} {str(cancellation_details.error_details)}，正在进行下一次尝试...")
+                    error = f"{str(cancellation_details.reason)} {str(cancellation_details.error_details)}"
+                    # 被限流等服务端错误时连接本身没问题，合成器继续使用；只有连接断开的才丢弃重建
+                    broken = cancellation_details.error_code == speechsdk.CancellationErrorCode.ConnectionFailure
+                else:
+                    broken = False
+                    error = str(result.reason)
             except Exception as e:
-                print(f"序号 {index} 的语音合成出错，错误信息：{str(e)}，正在进行下一次尝试...")
+                error = str(e)
+            finally:
+                self._release(item, broken)
+
+        raise RuntimeError(f"已尝试 {self.max_attempts} 次仍然失败：{error}")
+
+    async def get_tts_audio(self, message, language, index):
+        start = time.time()
+        begin = time.perf_counter()
+        try:
+            result, _, attempts, latency = await self.speak(self.build_ssml(html.escape(message), language), f"序号 {index}")
+        except RuntimeError as e:
+            metrics.record('tts', start, time.perf_counter() - begin, engine='azure', row=index, attempts=self.max_attempts, ok=False)
+            return {"index": index, "audio_data": None, "duration": None, "error": str(e)}
+
+        duration = result.audio_duration.total_seconds()
+        metrics.record('tts', start, time.perf_counter() - begin, engine='azure', row=index, attempts=attempts, latency=round(latency, 3), audio_duration=duration)
+        return {"index": index, "audio_data": BytesIO(result.audio_data), "duration": duration, "error": None}
+
+    async def get_batch_audio(self, rows, language):
+        # rows 为 [(序号, 文本), ...]：整批放进一个 SSML，每句前放一个以序号命名的书签，合成一次后按书签的位置切开。
+        # 书签缺失或音频无法切分时抛出 ValueError，由调用方改为逐句合成
+        start = time.time()
+        begin = time.perf_counter()
+        content = ''.join(f"<bookmark mark='{index}'/>{html.escape(message)}" for index, message in rows)
+        label = f"序号 {rows[0][0]}-{rows[-1][0]}"
+        try:
+            result, marks, attempts, latency = await self.speak(self.build_ssml(content, language), label)
+            parts = split_wav(result.audio_data, marks, [index for index, _ in rows])
+        except (RuntimeError, ValueError):
+            metrics.record('tts', start, time.perf_counter() - begin, engine='azure', row=rows[0][0], batch=len(rows), ok=False)
+            raise
 
-async def process_text_files(input_file, output_dir, language):
+        metrics.record('tts', start, time.perf_counter() - begin, engine='azure', row=rows[0][0], batch=len(rows), attempts=attempts,
+                       latency=round(latency, 3), audio_duration=result.audio_duration.total_seconds())
+        return [{"index": index, "audio_data": audio_data, "duration": duration, "error": None} for (index, _), (audio_data, duration) in zip(rows, parts)]
+
+    def close(self):
+        if self._pool is not None:
+            while not self._pool.empty():
+                item = self._pool.get_nowait()
+                if item is not None and item[1] is not None:
+                    item[1].close()
+        self._executor.shutdown(wait=False)
+
+def split_wav(audio_data, marks, indices):
+    # 每句从自己的书签切到下一句的书签；第一句从头开始（包括开头的静音），最后一句切到结尾
+    offsets = {}
+    for name, offset in marks:
+        offsets.setdefault(name, offset)
+    missing = [index for index in indices[1:] if str(index) not in offsets]
+    if missing:
+        raise ValueError(f"合成结果缺少书签：{missing}")
+
+    with wave.open(BytesIO(audio_data)) as reader:
+        params = reader.getparams()
+        frames = reader.readframes(params.nframes)
+    frame_size = params.sampwidth * params.nchannels
+    bounds = [0] + [min(params.nframes, round(offsets[str(index)] * params.framerate / 10_000_000)) for index in indices[1:]] + [params.nframes]
+    if any(end <= start for start, end in zip(bounds, bounds[1:])):
+        raise ValueError("书签的位置不是递增的，无法切分音频")
+
+    parts = []
+    for start, end in zip(bounds, bounds[1:]):
+        buffer = BytesIO()
+        with wave.open(buffer, 'wb') as writer:
+            writer.setparams(params)
+            writer.writeframes(frames[start * frame_size:end * frame_size])
+        parts.append((buffer, (end - start) / params.framerate))
+    return parts
+
+def make_batches(rows, batch_size, batch_chars):
+    # 按句数和总字数把相邻的句子分成一批，单句超过字数上限时自成一批
+    batches = []
+    current = []
+    chars = 0
+    for index, message in rows:
+        if current and (len(current) >= batch_size or chars + len(message) > batch_chars):
+            batches.append(current)
+            current = []
+            chars = 0
+        current.append((index, message))
+        chars += len(message)
+    if current:
+        batches.append(current)
+    return batches
+
+async def synthesize_to_file(provider, message, language, index, output_dir):
+    result = await provider.get_tts_audio(message, language, index)
+    if result['error']:
+        return result
+    return write_result(result, output_dir)
+
+async def synthesize_batch_to_files(provider, rows, language, output_dir):
+    if len(rows) > 1:
+        try:
+            return [write_result(result, output_dir) for result in await provider.get_batch_audio(rows, language)]
+        except (RuntimeError, ValueError) as e:
+            print(f"序号 {rows[0][0]}-{rows[-1][0]} 整批合成失败，改为逐句合成：{str(e)}")
+    return await asyncio.gather(*(synthesize_to_file(provider, message, language, index, output_dir) for index, message in rows))
+
+def write_result(result, output_dir):
+    output_path = os.path.join(output_dir, f"output_{result['index']}.wav")
+    with open(output_path, 'wb') as f:
+        f.write(result['audio_data'].getbuffer())
+    result['output_path'] = output_path
+    return result
+
+async def process_text_files(input_file, output_dir, language, provider=None):
+    manifest = open_manifest(MANIFEST_PATH, input_file)
+    provider = provider or SpeechProvider()
+    rows = [(row['idx'], row['original']) for row in manifest.iter_rows() if row['original']]
+    # 短句单独请求时每次的固定开销占了大头，多句拼成一个请求合成后再切开
+    tasks = [synthesize_batch_to_files(provider, batch, language, output_dir) for batch in make_batches(rows, tts_batch_size, tts_batch_chars)]
+    results = []
+    progress = async_tqdm(total=len(rows), desc="正在合成配音")
+    for f in asyncio.as_completed(tasks):
+        for result in await f:
+            if result['error']:
+                progress.write(f"序号 {result['index']} 的配音生成失败：{result['error']}")
+            else:
+                manifest.update(result['index'], voice_path=relative_path(result['output_path']), audio_duration=result['duration'])
+            results.append(result)
+            progress.update(1)
+    progress.close()
+    provider.close()
+    manifest.close()
+    return results
+
+def main():
     print("软件作者：西装革律")
     print("禁止倒卖，违者必究！")
     print("交流群：797579852")
 
-    wb = openpyxl.load_workbook(input_file)
-    sheet = wb.active
-    column = sheet["D"]
-    provider = SpeechProvider()
-    tasks = [provider.get_tts_audio(cell.value, language, i) for i, cell in enumerate(column, 1)]
-    results = []
-    for f in async_tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="正在合成配音"):
-        result = await f
-        audio_data = result['audio_data']
-        output_path = os.path.join(script_directory, output_dir, f"output_{result['index']}.wav")
-        with open(output_path, 'wb') as f:
-            f.write(audio_data.getbuffer())
-        results.append(result)
-    return results
+    metrics.start_run()
+    parser = argparse.ArgumentParser(description='文本转语音转换器')
+    parser.add_argument('--input_file', type=str, default="txt/txt.xlsx", help='人工编辑用的表格，比文本清单新时会先导入清单')
+    parser.add_argument('--output_dir', type=str, default="voice", help='输出目录的路径')
+    parser.add_argument('--language', type=str, default="zh-CN", help='文本的语言')
+    parser.add_argument('--fake_tts', action='store_true', help='使用本地模拟的合成器（生成音调代替语音），用于在没有密钥时测试')
 
-parser = argparse.ArgumentParser(description='文本转语音转换器')
-parser.add_argument('--input_file', type=str, default="txt/txt.xlsx", help='输入文本文件的路径')
-parser.add_argument('--output_dir', type=str, default="voice", help='输出目录的路径')
-parser.add_argument('--language', type=str, default="zh-CN", help='文本的语言')
+    args = parser.parse_args()
 
-args = parser.parse_args()
+    script_directory = os.path.dirname(os.path.abspath(__file__))
 
-script_directory = os.path.dirname(os.path.abspath(__file__))
+    args.input_file = os.path.join(script_directory, '..', args.input_file.replace('/', '\\'))
+    args.output_dir = os.path.join(script_directory, '..', args.output_dir)
 
-args.input_file = os.path.join(script_directory, '..', args.input_file.replace('/', '\\'))
-args.output_dir = os.path.join(script_directory, '..', args.output_dir)
+    provider = None
+    if args.fake_tts:
+        from fake_azure_tts import FakeSynthesizer
+        provider = SpeechProvider(synthesizer_factory=FakeSynthesizer)
+    asyncio.run(process_text_files(args.input_file, args.output_dir, args.language, provider))
+    metrics.finish_run()
 
-asyncio.run(process_text_files(args.input_file, args.output_dir, args.language))
+if __name__ == '__main__':
+    main()
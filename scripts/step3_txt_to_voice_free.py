@@ -1,13 +1,21 @@
 import os
 import json
-import openpyxl
+import time
+import wave
 import asyncio
+import aiohttp
 from tqdm import tqdm
 import argparse
 import aiofiles
 import edge_tts
 import edge_tts.exceptions
 import chardet
+from manifest import open_manifest, relative_path, MANIFEST_PATH
+from rate_limiter import backoff_delay
+from ffmpeg_tools import get_ffmpeg_binary, probe_duration
+import metrics
+
+audio_extensions = ['.wav', '.mp3']
 
 def get_encoding(file_path):
     with open(file_path, 'rb') as f:
@@ -18,104 +26,173 @@ class SpeechProvider:
         encoding = get_encoding(config_file)
         with open(config_file, 'r', encoding=encoding) as f:
             self._config = json.load(f)
-
-    async def async_get_tts_audio(self, message, language):
-        voice = self._config.get('voice')
-        if voice is None:
-            return None, None
-
-        wav = b''
+        self.voice = self._config.get('voice')
+        # edge-tts 返回的是 MP3：wav=解码一次存成真正的 PCM WAV，mp3=原样保存
+        self.output_format = self._config.get('edge_tts_output', 'wav')
+        self.concurrency = max(1, int(self._config.get('edge_tts_concurrency', 4)))
+        self.max_attempts = max(1, int(self._config.get('edge_tts_max_attempts', 5)))
+
+    async def stream_to_file(self, message, path):
+        # 收到一段写一段，不在内存里拼接整段音频；返回写入的字节数，没有收到音频时为 0
         service_data = {
-            "voice": voice,
+            "voice": self.voice,
             "rate": self._config.get('rate'),
             "volume": self._config.get('volume')
         }
 
         tts = edge_tts.Communicate(message, **service_data)
-        try:
-            async for chunk in tts.stream():
-                if chunk["type"] == "audio":
-                    wav += chunk["data"]
-        except edge_tts.exceptions.NoAudioReceived:
-            return None, None
-
-        return 'wav', wav
+        size = 0
+        async with aiofiles.open(path, "wb") as f:
+            try:
+                async for chunk in tts.stream():
+                    if chunk["type"] == "audio":
+                        await f.write(chunk["data"])
+                        size += len(chunk["data"])
+            except edge_tts.exceptions.NoAudioReceived:
+                return 0
+        return size
+
+providers = {}
+
+def get_provider(config_file):
+    # 同一个配置文件只读取一次，所有句子共用
+    key = os.path.abspath(config_file)
+    if key not in providers:
+        providers[key] = SpeechProvider(config_file)
+    return providers[key]
+
+def is_throttled(error):
+    # edge-tts 没有单独的限流异常，被限流时服务端拒绝 WebSocket 握手，aiohttp 抛出状态码 429 的异常
+    return isinstance(error, aiohttp.ClientResponseError) and error.status == 429
+
+async def decode_to_wav(mp3_path, wav_path):
+    process = await asyncio.create_subprocess_exec(get_ffmpeg_binary(), '-hide_banner', '-loglevel', 'error', '-y', '-i', mp3_path,
+                                                   '-acodec', 'pcm_s16le', wav_path, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    _, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise Exception(f"音频解码失败：{stderr.decode('utf-8', errors='ignore').strip()}")
+
+def wav_duration(path):
+    with wave.open(path) as reader:
+        return reader.getnframes() / reader.getframerate()
+
+def remove_stale_audio(file_path):
+    # 换了保存格式时删掉同一编号的旧文件，避免视频合成读到旧配音
+    stem = os.path.splitext(file_path)[0]
+    for ext in audio_extensions:
+        if stem + ext != file_path and os.path.exists(stem + ext):
+            os.remove(stem + ext)
 
 async def convert_text_to_audio(text, language, output_path, row_index, config_file):
+    # 成功时返回 {'output_path': 音频文件路径, 'duration': 时长（秒）}，失败返回 False
     if not text:
         return False
 
-    provider = SpeechProvider(config_file)
-    attempt = 0  
-    wait_time = 1  
-
-    while True:
-        try:
-            audio_format, audio_data = await provider.async_get_tts_audio(text, language)
-            if audio_data is not None:
-                wav_file_path = os.path.join(output_path, f"output_{row_index}.wav")
-
-                async with aiofiles.open(wav_file_path, "wb") as f:
-                    await f.write(audio_data)
-
-                if not os.path.exists(wav_file_path) or os.path.getsize(wav_file_path) == 0:
-                    raise Exception(f"音频文件生成失败或文件大小为0: {wav_file_path}")
-
-                return True
-        except Exception as e:
-            print(f"尝试 {attempt + 1} 失败，原因：{str(e)}。将在 {wait_time} 秒后重试。")
-            await asyncio.sleep(wait_time)  
-            attempt += 1  
-            wait_time *= 2   
-        except edge_tts.exceptions.RateLimitException:  
-            print("超过速率限制。将在 60 秒后重试。")
-            await asyncio.sleep(60)
+    provider = get_provider(config_file)
+    if provider.voice is None:
+        print("配置文件中没有填写配音人（voice）")
+        return False
+
+    stem = os.path.join(output_path, f"output_{row_index}")
+    part_path = stem + '.mp3.part'
+    start = time.time()
+    begin = time.perf_counter()
+
+    try:
+        for attempt in range(provider.max_attempts):
+            try:
+                request_start = time.perf_counter()
+                size = await provider.stream_to_file(text, part_path)
+                if size == 0:
+                    raise Exception(f"没有收到音频：output_{row_index}")
+
+                if provider.output_format == 'wav':
+                    file_path = stem + '.wav'
+                    await decode_to_wav(part_path, file_path)
+                    duration = wav_duration(file_path)
+                else:
+                    file_path = stem + '.mp3'
+                    os.replace(part_path, file_path)
+                    duration = probe_duration(file_path)
+                remove_stale_audio(file_path)
+
+                metrics.record('tts', start, time.perf_counter() - begin, engine='edge', row=row_index, attempts=attempt + 1,
+                               latency=round(time.perf_counter() - request_start, 3), bytes=size, audio_duration=duration)
+                return {'output_path': file_path, 'duration': duration}
+            except Exception as e:
+                if is_throttled(e):
+                    delay = 60
+                    print("超过速率限制。将在 60 秒后重试。")
+                else:
+                    delay = backoff_delay(attempt, base=1, cap=30)
+                    print(f"尝试 {attempt + 1} 失败，原因：{str(e)}。将在 {delay:.1f} 秒后重试。")
+            if attempt + 1 < provider.max_attempts:
+                await asyncio.sleep(delay)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+    metrics.record('tts', start, time.perf_counter() - begin, engine='edge', row=row_index, attempts=provider.max_attempts, ok=False)
+    print(f"序号 {row_index} 已尝试 {provider.max_attempts} 次仍然失败，跳过")
     return False
 
 async def process_text_files(input_file, output_dir, language, config_file):
-    print("软件作者：西装革律")
-    print("禁止倒卖，违者必究！")
-    print("交流群：797579852")  
-    
-    wb = openpyxl.load_workbook(input_file)
-    sheet = wb.active
-    column = sheet["D"]
-    tasks = []
-    row_index = 1
-
-    for cell in column:
-        text = cell.value
-        if text:
-            tasks.append(asyncio.create_task(convert_text_to_audio(text, language, output_dir, row_index, config_file)))
-            row_index += 1
+    manifest = open_manifest(MANIFEST_PATH, input_file)
+    # 同时进行的请求数有上限，不会一次把所有句子都发出去
+    semaphore = asyncio.Semaphore(get_provider(config_file).concurrency)
+
+    async def convert(text, row_index):
+        async with semaphore:
+            return await convert_text_to_audio(text, language, output_dir, row_index, config_file)
+
+    tasks = {}
+
+    # 配音序号取清单的行号，跳过空行时也不会和图片编号错位
+    for row in manifest.iter_rows():
+        if row['original']:
+            task = asyncio.create_task(convert(row['original'], row['idx']))
+            tasks[task] = row['idx']
 
     progress_bar = tqdm(desc="正在生成配音音频", total=len(tasks), unit="files")
 
-    while tasks:
-        done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    pending = set(tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
         for task in done:
             try:
-                if task.result():
+                result = task.result()
+                if result:
+                    manifest.update(tasks[task], voice_path=relative_path(result['output_path']), audio_duration=result['duration'])
                     progress_bar.update(1)
-            except edge_tts.exceptions.EdgeTTSException as e:
+            except Exception as e:
                 progress_bar.write(f"发生错误：{str(e)}")
     progress_bar.close()
+    manifest.close()
+
+def main():
+    print("软件作者：西装革律")
+    print("禁止倒卖，违者必究！")
+    print("交流群：797579852")  
+
+    parser = argparse.ArgumentParser(description='Text to Speech Converter')
+    script_dir = os.path.dirname(os.path.realpath(__file__))
 
-parser = argparse.ArgumentParser(description='Text to Speech Converter')
-script_dir = os.path.dirname(os.path.realpath(__file__))
+    default_input_file = os.path.join(script_dir, "..", "txt", "txt.xlsx")
+    default_output_dir = os.path.join(script_dir, "..", "voice")
 
-default_input_file = os.path.join(script_dir, "..", "txt", "txt.xlsx")
-default_output_dir = os.path.join(script_dir, "..", "voice")
+    default_config_file = os.path.join(script_dir, "..", "config.json")
 
-default_config_file = os.path.join(script_dir, "..", "config.json")
+    parser.add_argument('--input_file', type=str, default=default_input_file, help='人工编辑用的表格，比文本清单新时会先导入清单')
+    parser.add_argument('--output_dir', type=str, default=default_output_dir, help='输出目录的路径')
+    parser.add_argument('--config_file', type=str, default=default_config_file, help='配置文件的路径')
 
-parser.add_argument('--input_file', type=str, default=default_input_file, help='输入文本文件的路径')
-parser.add_argument('--output_dir', type=str, default=default_output_dir, help='输出目录的路径')
-parser.add_argument('--config_file', type=str, default=default_config_file, help='配置文件的路径')
+    parser.add_argument('--language', type=str, default="zh-CN", help='文本的语言')
 
-parser.add_argument('--language', type=str, default="zh-CN", help='文本的语言')
+    args = parser.parse_args()
 
-args = parser.parse_args()
-provider = SpeechProvider(args.config_file)
+    metrics.start_run()
+    asyncio.run(process_text_files(args.input_file, args.output_dir, args.language, args.config_file))
+    metrics.finish_run()
 
-asyncio.run(process_text_files(args.input_file, args.output_dir, args.language, args.config_file))
+if __name__ == '__main__':
+    main()
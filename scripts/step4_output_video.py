@@ -1,22 +1,52 @@
 import os
 import gc
+import time
+import argparse
 import random
-from concurrent.futures import ThreadPoolExecutor
-from PIL import Image, ImageFilter
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from queue import Empty
+from PIL import Image
 from moviepy.editor import (
-    ImageSequenceClip,
+    VideoClip,
     AudioFileClip,
-    CompositeVideoClip,
     concatenate_videoclips,
-    VideoFileClip,
-    vfx
+    VideoFileClip
 )
 import json
 from datetime import datetime
 import chardet
-import concurrent.futures
 from tqdm import tqdm
-import numpy as np
+from motion import KenBurnsRenderer, CROP_RATIO
+from compositor import BackgroundCompositor, make_background
+from ffmpeg_tools import can_stream_copy, concat_stream_copy
+from manifest import Manifest, MANIFEST_PATH, relative_path
+import metrics
+
+extensions = ['.png', '.webp', '.jpg', '.jpeg']
+audio_extensions = ['.wav', '.mp3']
+
+# 每个渲染进程自身（解释器、moviepy、ffmpeg 子进程）的大致常驻内存
+WORKER_BASE_MEMORY = 300 * 1024 * 1024
+# ffmpeg 编码器（x264 lookahead 等）缓存的帧数按这个估算
+ENCODER_BUFFERED_FRAMES = 40
+
+# 所有片段用完全相同的编码参数输出，最终合成时才能直接按容器拼接；
+# yuv420p 要求宽高都是偶数，奇数尺寸（例如 512 放大 1.1 倍的毛玻璃背景）先在右侧/下方补一像素
+SEGMENT_CODEC_PARAMS = {
+    'codec': 'libx264',
+    'audio_codec': 'aac',
+    'audio_fps': 44100,
+    'audio_bitrate': '192k',
+    'ffmpeg_params': ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p'],
+}
+
+# 预览片段只换成最快的编码预设，其余参数不变，预览片段之间同样可以直接拼接
+PREVIEW_CODEC_PARAMS = dict(SEGMENT_CODEC_PARAMS, preset='ultrafast')
+
+# 片段渲染逻辑有改动、旧缓存不再适用时修改这个版本号
+SEGMENT_CACHE_VERSION = 2
 
 def get_config():
     config_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.json')
@@ -27,104 +57,339 @@ def get_config():
 
     return json.loads(raw_data.decode(encoding))
 
-def transform_image(img, t, x_speed, y_speed, move_on_x, move_positive):
-    original_size = img.size
+def make_segment_clip(img, n_frames, duration, fps, x_speed, y_speed, move_on_x, move_positive, enlarge_background, smooth=False, blur_background=True):
+    # 编码器需要哪一帧才计算哪一帧，前景直接画进预先铺好毛玻璃背景的画布
+    renderer = KenBurnsRenderer(img, n_frames, fps, x_speed, y_speed, move_on_x, move_positive, smooth=smooth)
+    if not blur_background:
+        return VideoClip(renderer.make_frame, duration=duration).set_fps(fps)
+    compositor = BackgroundCompositor(make_background(img, enlarge_background), renderer)
+    return VideoClip(compositor.make_frame, duration=duration).set_fps(fps)
 
-    crop_width = img.width * 0.8
-    crop_height = img.height * 0.8
-    if move_on_x:
-        left = min(x_speed * t, img.width - crop_width) if move_positive else max(img.width - crop_width - x_speed * t, 0)
-        upper = (img.height - crop_height) / 2
-    else:
-        upper = min(y_speed * t, img.height - crop_height) if move_positive else max(img.height - crop_height - y_speed * t, 0)
-        left = (img.width - crop_width) / 2
+def resize_for_preview(img, height):
+    # yuv420p 要求宽高都是偶数；图片本身比预览尺寸小时不放大
+    height = min(height, img.height)
+    height = max(2, height - height % 2)
+    width = max(2, round(img.width * height / img.height / 2) * 2)
+    return img.resize((width, height), Image.BILINEAR)
+
+def find_image(image_dir, index):
+    for ext in extensions:
+        path = os.path.join(image_dir, f'output_{index}{ext}')
+        if os.path.exists(path):
+            return path
+    return None
 
-    right = left + crop_width
-    lower = upper + crop_height
+def find_audio(voice_dir, index):
+    # 免费配音可以直接保存 edge-tts 的 MP3
+    for ext in audio_extensions:
+        path = os.path.join(voice_dir, f'output_{index}{ext}')
+        if os.path.exists(path):
+            return path
+    return None
 
-    cropped_img = img.crop((left, upper, right, lower))
-    
-    return cropped_img.resize(original_size)
+def list_segment_indices(image_dir):
+    indices = set()
+    for name in os.listdir(image_dir):
+        stem, ext = os.path.splitext(name)
+        if ext.lower() in extensions and stem.startswith('output_') and stem[len('output_'):].isdigit():
+            indices.add(int(stem[len('output_'):]))
+    return sorted(indices)
 
-print("软件作者：西装革律")
-print("禁止倒卖，违者必究！")
-print("交流群：797579852")
+def estimate_segment_memory(settings, plan):
+    with Image.open(plan['image_path']) as im:
+        width, height = im.size
 
-current_dir = os.path.dirname(os.path.abspath(__file__))
-parent_dir = os.path.dirname(current_dir)
+    frame = width * height * 3
+    canvas = frame * 1.21 if settings['enlarge_background'] else frame
+    buffers = frame + frame / CROP_RATIO ** 2 + canvas + frame
+    if settings['smooth_motion']:
+        buffers += frame * 4 * 2
+    return WORKER_BASE_MEMORY + buffers + canvas * ENCODER_BUFFERED_FRAMES
 
-config = get_config()
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-image_dir = os.path.join(parent_dir, 'image')
-voice_dir = os.path.join(parent_dir, 'voice')
-video_dir = os.path.join(parent_dir, 'video')
-temp_dir = os.path.join(parent_dir, 'temp')
+def plan_segment(index, settings):
+    image_path = find_image(settings['image_dir'], index)
+    audio_path = find_audio(settings['voice_dir'], index)
+    image_hash = file_digest(image_path)
+    audio_hash = file_digest(audio_path)
 
-os.makedirs(temp_dir, exist_ok=True)
+    # 运镜方向由随机种子和图片内容决定：同一张图每次渲染结果一致，重绘之后才会变
+    rng = random.Random(f"{settings['render_seed']}:{image_hash}")
+    move_on_x = rng.choice([True, False])
+    move_positive = rng.choice([True, False])
 
-total_files = len(os.listdir(image_dir))
-fps = config['fps']
-enlarge_background = config['enlarge_background']
-enable_effect = config['enable_effect']
-effect_type = config['effect_type']
+    key_source = json.dumps({
+        'version': SEGMENT_CACHE_VERSION,
+        'image': image_hash,
+        'audio': audio_hash,
+        'fps': settings['fps'],
+        # 预览片段的时长按正式渲染的帧数取整，正式帧数改了预览也要重新渲染
+        'timing_fps': settings['timing_fps'],
+        'enlarge_background': settings['enlarge_background'],
+        'smooth_motion': settings['smooth_motion'],
+        'preview_height': settings['preview_height'],
+        'move_on_x': move_on_x,
+        'move_positive': move_positive,
+        'codec': settings['codec_params'],
+    }, sort_keys=True)
 
-extensions = ['.png', '.jpg', '.jpeg']
-for i in tqdm(range(total_files), ncols=None, desc="正在生成视频"):
-    filename = f'output_{i+1}'
-    audio_filename = f'output_{i+1}'
-    temp_filename = os.path.join(temp_dir, f'output_{i+1}.mp4')
+    return {
+        'index': index,
+        'image_path': image_path,
+        'audio_path': audio_path,
+        'move_on_x': move_on_x,
+        'move_positive': move_positive,
+        'key': hashlib.sha256(key_source.encode('utf-8')).hexdigest(),
+    }
 
-    for ext in extensions:
-        try:
-            im = Image.open(os.path.join(image_dir, filename + ext))
-            break
-        except FileNotFoundError:
-            continue
+def segment_paths(settings, index):
+    return (os.path.join(settings['temp_dir'], f'output_{index}.mp4'),
+            os.path.join(settings['temp_dir'], f'output_{index}.json'))
 
-    audio = AudioFileClip(os.path.join(voice_dir, audio_filename + '.wav'))
+def read_segment_record(settings, index):
+    temp_filename, record_filename = segment_paths(settings, index)
+    if not os.path.exists(temp_filename) or not os.path.exists(record_filename):
+        return {}
+    try:
+        with open(record_filename, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-    effect_type = random.choice([0, 1])
+def is_segment_cached(plan, settings):
+    return read_segment_record(settings, plan['index']).get('key') == plan['key']
 
-    if effect_type == 0:
-        x_speed = (im.width - im.width * 0.8) / audio.duration
-        y_speed = 0
-        move_on_x = True
-        move_positive = random.choice([True, False])
-    elif effect_type == 1:
-        x_speed = 0
-        y_speed = (im.height - im.height * 0.8) / audio.duration
-        move_on_x = False
-        move_positive = random.choice([True, False])
+class FrameProgress:
+    def __init__(self, queue, index, n_frames, fps):
+        self._queue = queue
+        self._index = index
+        self._n_frames = n_frames
+        self._every = max(1, int(fps))
+        self._done = 0
 
-    n_frames = int(fps * audio.duration)
-    frames_foreground = [np.array(transform_image(im, t / fps, x_speed, y_speed, move_on_x, move_positive)) for t in range(n_frames)]
-    img_foreground = ImageSequenceClip(frames_foreground, fps=fps)
+    def __call__(self, get_frame, t):
+        frame = get_frame(t)
+        self._done = min(self._done + 1, self._n_frames)
+        if self._done % self._every == 0 or self._done == self._n_frames:
+            self._queue.put((os.getpid(), self._index, self._done, self._n_frames))
+        return frame
 
-    img_blur = im.filter(ImageFilter.GaussianBlur(radius=30))
-    if enlarge_background:
-        img_blur = img_blur.resize((int(im.width * 1.1), int(im.height * 1.1)), Image.ANTIALIAS)
+def render_segment(plan, settings, progress_queue=None, threads=None, logger='bar'):
+    start = time.time()
+    begin = time.perf_counter()
+    fps = settings['fps']
+    index = plan['index']
+    temp_filename, record_filename = segment_paths(settings, index)
+    # 先删掉旧记录，渲染中途失败时不会把半成品当成缓存
+    if os.path.exists(record_filename):
+        os.remove(record_filename)
 
-    frames_background = [np.array(img_blur)] * n_frames
-    img_background = ImageSequenceClip(frames_background, fps=fps)
+    im = Image.open(plan['image_path'])
+    audio = AudioFileClip(plan['audio_path'])
+    preview = bool(settings['preview_height'])
+    if preview:
+        im = resize_for_preview(im, settings['preview_height'])
 
-    img_foreground = img_foreground.set_audio(audio)
+    move_on_x = plan['move_on_x']
+    move_positive = plan['move_positive']
+    x_speed = (im.width - im.width * 0.8) / audio.duration if move_on_x else 0
+    y_speed = 0 if move_on_x else (im.height - im.height * 0.8) / audio.duration
 
-    final_clip = CompositeVideoClip([img_background.set_position("center"), img_foreground.set_position("center")], size=img_blur.size)
+    # 片段时长始终按正式渲染的帧数计算，预览降低帧数后时间轴也与正式版完全一致
+    duration = int(settings['timing_fps'] * audio.duration) / settings['timing_fps']
+    n_frames = max(1, round(fps * duration))
+    final_clip = make_segment_clip(im, n_frames, duration, fps, x_speed, y_speed, move_on_x, move_positive, settings['enlarge_background'],
+                                   smooth=settings['smooth_motion'], blur_background=not preview)
+    if progress_queue is not None:
+        final_clip = final_clip.fl(FrameProgress(progress_queue, index, n_frames, fps))
+    final_clip = final_clip.set_audio(audio)
 
-    final_clip = {
-        'fade': final_clip.fadein(1).fadeout(1),
-        'slide': final_clip.crossfadein(1).crossfadeout(1),
-        'rotate': final_clip.rotate(lambda t: 360*t/10),
-        'scroll': final_clip.fx(vfx.scroll, y_speed=50),
-        'flip_horizontal': final_clip.fx(vfx.mirror_x),
-        'flip_vertical': final_clip.fx(vfx.mirror_y)
-    }.get(effect_type, final_clip)
+    # 并行渲染时各进程的 moviepy 进度条会互相打乱，改由主进程统一显示
+    if progress_queue is not None:
+        logger = None
+    encode_start = time.perf_counter()
+    # 帧是在编码过程中逐帧生成的，这段时间的内存（渲染进程 + ffmpeg）就是这个片段的峰值
+    with metrics.MemorySampler() as memory:
+        final_clip.write_videofile(temp_filename, threads=threads, logger=logger, **settings['codec_params'])
+    encode_time = time.perf_counter() - encode_start
+    audio.close()
+    im.close()
 
+    with open(record_filename, 'w', encoding='utf-8') as f:
+        json.dump({'key': plan['key'], 'duration': duration}, f)
 
-    final_clip.write_videofile(temp_filename)
     gc.collect()
+    metrics.record('render', start, time.perf_counter() - begin, row=index, frames=n_frames, encode=round(encode_time, 3),
+                   fps=round(n_frames / encode_time, 2) if encode_time else None, peak_rss_mb=memory.peak_mb)
+    return temp_filename
+
+def render_segments_serial(plans, settings):
+    for plan in tqdm(plans, ncols=None, desc="正在生成视频"):
+        render_segment(plan, settings)
+
+def render_segments_parallel(plans, settings, workers, memory_budget):
+    manager = multiprocessing.Manager()
+    progress_queue = manager.Queue()
+    # 多个 ffmpeg 同时编码，平分 CPU 核心，避免线程数远超核心数
+    threads = max(1, (os.cpu_count() or 1) // workers)
+
+    pending = list(plans)
+    running = {}
+    in_flight_memory = 0
+    worker_bars = {}
+
+    overall = tqdm(total=len(plans), ncols=None, desc="正在生成视频", position=0)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            # 按顺序提交片段：在途片段数不超过进程数，估算内存不超过预算，
+            # 预算再小也至少保证有一个片段在渲染
+            while pending and len(running) < workers:
+                estimate = estimate_segment_memory(settings, pending[0])
+                if running and in_flight_memory + estimate > memory_budget:
+                    break
+                plan = pending.pop(0)
+                running[executor.submit(render_segment, plan, settings, progress_queue, threads)] = (plan['index'], estimate)
+                in_flight_memory += estimate
+
+            done, _ = wait(running, timeout=0.5, return_when=FIRST_COMPLETED)
+
+            while True:
+                try:
+                    pid, index, frames_done, n_frames = progress_queue.get_nowait()
+                except Empty:
+                    break
+                if pid not in worker_bars:
+                    slot = len(worker_bars) + 1
+                    worker_bars[pid] = (slot, tqdm(total=n_frames, ncols=None, position=slot, unit='frame', leave=False))
+                slot, bar = worker_bars[pid]
+                if bar.total != n_frames or frames_done < bar.n:
+                    bar.reset(total=n_frames)
+                bar.set_description(f"进程{slot} 片段{index}")
+                bar.update(frames_done - bar.n)
+
+            for future in done:
+                index, estimate = running.pop(future)
+                in_flight_memory -= estimate
+                future.result()
+                overall.update(1)
+
+    for slot, bar in worker_bars.values():
+        bar.close()
+    overall.close()
+    manager.shutdown()
+
+def concatenate_segments(temp_filenames, output_file, durations=None):
+    with metrics.timer('concat', segments=len(temp_filenames)) as fields:
+        if can_stream_copy(temp_filenames):
+            try:
+                print("正在拼接视频片段...")
+                fields['method'] = 'stream_copy'
+                return concat_stream_copy(temp_filenames, output_file, durations)
+            except RuntimeError as e:
+                print(f"直接拼接失败，改为重新编码：{str(e)}")
+        else:
+            print("视频片段的编码参数不一致（例如图片尺寸不同），改为重新编码合成")
+
+        fields['method'] = 'reencode'
+        final_video = concatenate_videoclips([VideoFileClip(filename) for filename in temp_filenames], method="compose")
+        final_video.write_videofile(output_file)
+        return output_file
+
+def build_settings(config, parent_dir, preview=False):
+    image_dir = os.path.join(parent_dir, 'image')
+    voice_dir = os.path.join(parent_dir, 'voice')
+    temp_dir = os.path.join(parent_dir, 'temp')
+    os.makedirs(temp_dir, exist_ok=True)
+
+    settings = {
+        'image_dir': image_dir,
+        'voice_dir': voice_dir,
+        'temp_dir': temp_dir,
+        'fps': config['fps'],
+        'enlarge_background': config['enlarge_background'],
+        'smooth_motion': config.get('smooth_motion', False),
+        'render_seed': config.get('render_seed', 0),
+        'timing_fps': config['fps'],
+        'preview_height': 0,
+        'codec_params': SEGMENT_CODEC_PARAMS,
+    }
+
+    output_name = 'output'
+    if preview:
+        settings.update({
+            'temp_dir': os.path.join(temp_dir, 'preview'),
+            'fps': config.get('preview_fps', 15),
+            'enlarge_background': False,
+            'smooth_motion': False,
+            'preview_height': config.get('preview_height', 360),
+            'codec_params': PREVIEW_CODEC_PARAMS,
+        })
+        os.makedirs(settings['temp_dir'], exist_ok=True)
+        output_name = 'preview'
+    return settings, output_name
+
+def main():
+    print("软件作者：西装革律")
+    print("禁止倒卖，违者必究！")
+    print("交流群：797579852")
+
+    parser = argparse.ArgumentParser(description='视频合成')
+    parser.add_argument('--preview', action='store_true', help='快速预览：低分辨率、低帧数、无毛玻璃，分段与时间轴与正式渲染一致')
+    args = parser.parse_args()
+
+    # 渲染子进程启动前确定运行编号，子进程的性能数据才会归到同一次运行
+    metrics.start_run()
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    parent_dir = os.path.dirname(current_dir)
+
+    config = get_config()
+    image_dir = os.path.join(parent_dir, 'image')
+    video_dir = os.path.join(parent_dir, 'video')
+    settings, output_name = build_settings(config, parent_dir, args.preview)
+
+    indices = list_segment_indices(image_dir)
+    # 配音多次失败的句子没有音频文件，跳过这些片段，不让一句话拖垮整个合成
+    missing = [index for index in indices if find_audio(settings['voice_dir'], index) is None]
+    if missing:
+        print(f"以下序号没有配音文件，跳过对应的视频片段：{', '.join(map(str, missing))}。重新运行配音后再合成即可补上")
+        indices = [index for index in indices if index not in missing]
+    if not indices:
+        print("没有可以合成的视频片段")
+        metrics.finish_run()
+        return
+    plans = [plan_segment(index, settings) for index in indices]
+    if config.get('render_cache', True):
+        plans_to_render = [plan for plan in plans if not is_segment_cached(plan, settings)]
+        print(f"复用未改动的视频片段 {len(plans) - len(plans_to_render)} 个，需要渲染 {len(plans_to_render)} 个")
+    else:
+        plans_to_render = plans
+
+    workers = int(config.get('render_workers', 1)) or os.cpu_count() or 1
+    memory_budget = int(config.get('render_memory_budget_mb', 8192)) * 1024 * 1024
+
+    if workers > 1 and len(plans_to_render) > 1:
+        render_segments_parallel(plans_to_render, settings, min(workers, len(plans_to_render)), memory_budget)
+    else:
+        render_segments_serial(plans_to_render, settings)
+
+    temp_filenames = [segment_paths(settings, index)[0] for index in indices]
+    if not args.preview:
+        manifest = Manifest(MANIFEST_PATH)
+        for index, temp_filename in zip(indices, temp_filenames):
+            manifest.update(index, segment_path=relative_path(temp_filename))
+        manifest.close()
+
+    durations = [read_segment_record(settings, index).get('duration') for index in indices]
+    output_file = concatenate_segments(temp_filenames, os.path.join(video_dir, f'{output_name}_{datetime.now().strftime("%Y%m%d%H%M%S")}.mp4'), durations)
+    if args.preview:
+        print(f"预览视频已生成：{output_file}")
+    metrics.finish_run()
 
-temp_filenames = [os.path.join(temp_dir, f'output_{i+1}.mp4') for i in range(total_files)]
-temp_filenames.sort(key=lambda x: int(x.split('_')[-1].split('.')[0]))
-final_video = concatenate_videoclips([VideoFileClip(filename) for filename in temp_filenames], method="compose")
-final_video.write_videofile(os.path.join(video_dir, f'output_{datetime.now().strftime("%Y%m%d%H%M%S")}.mp4'))
+if __name__ == '__main__':
+    main()
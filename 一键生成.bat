@@ -0,0 +1,4 @@
+@echo off
+cls
+python.exe scripts\pipeline.py
+pause
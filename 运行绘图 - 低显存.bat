@@ -1,4 +1,4 @@
 @echo off
 cls
-python.exe scripts\step2_txt_to_image_low.py
+python.exe scripts\step2_txt_to_image.py --profile low
 pause
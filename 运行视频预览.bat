@@ -0,0 +1,4 @@
+@echo off
+cls
+python.exe scripts\step4_output_video.py --preview
+pause
\ No newline at end of file